@@ -0,0 +1,251 @@
+# AsyncGitSuperRepository.py
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+===============================
+AsyncGitSuperRepository Package
+===============================
+
+The AsyncGitSuperRepository package provides the AsyncGitSuperRepository
+class, an asyncio counterpart to GitSuperRepository. Its git commands run as
+asyncio subprocesses, so that a single event loop can drive many
+super-repositories at once without blocking. This package requires Python 3.
+"""
+
+import asyncio
+import os
+import re
+import signal
+from subprocess import CalledProcessError, PIPE, STDOUT
+
+from GitSuperRepository import GitSuperRepository, Commit
+
+def kill(process):
+    """Kill an asyncio subprocess if it is still running."""
+    # Process.kill polls the process first, which can reap it behind the back
+    # of asyncio's child watcher and lose its exit status
+    if process.returncode == None:
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+async def gather_limited(function, items, jobs=8, return_exceptions=False):
+    """
+    Await function(item) for each of items, running at most 'jobs' of them at
+    once, and return the list of results in the same order as items.
+
+    If return_exceptions is True, exceptions are returned in the list of
+    results in the same way as asyncio.gather. Otherwise the first exception
+    is raised once all of the others have been cancelled, as are all of them
+    if gather_limited is itself cancelled.
+    """
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def limited(item):
+        async with semaphore:
+            return await function(item)
+
+    tasks = [asyncio.ensure_future(limited(item)) for item in items]
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+class AsyncGitSuperRepository():
+    """
+    Creating an AsyncGitSuperRepository object binds the object to a specific
+    git repository, in the same way as for GitSuperRepository.
+    """
+    def __init__(self, path=None, jobs=8):
+        """
+        Create an AsyncGitSuperRepository object to manage a git repository.
+
+        The root of the git repository is 'path', as for GitSuperRepository.
+        Operations on several submodules run at most 'jobs' git commands at
+        once unless told otherwise.
+        """
+        self.__repo = GitSuperRepository(path)
+        self.__jobs = jobs
+
+    def repository(self):
+        """Get the GitSuperRepository object for the repository."""
+        return self.__repo
+
+    async def git_command(self, command, module=None, exceptions=True, stderr=None):
+        """
+        Execute a git command on the repository. If the calling task is
+        cancelled, the git process is killed.
+        """
+        loop = asyncio.get_event_loop()
+        (args, cwd) = await loop.run_in_executor(None,
+            self.__repo.git_invocation, command, module)
+        process = await asyncio.create_subprocess_exec(*args, cwd=cwd,
+            stdout=PIPE, stderr=stderr)
+        try:
+            output = (await process.communicate())[0]
+        except asyncio.CancelledError:
+            kill(process)
+            await process.wait()
+            raise
+
+        if process.returncode != 0:
+            if exceptions:
+                raise CalledProcessError(process.returncode, args, output)
+            print(output.decode('utf_8'), end='')
+            return None
+        return output.decode('utf_8').rstrip('\n')
+
+    async def config(self, command, module=None, file=None):
+        """Configure the repository."""
+        if file != None:
+            command = ['--file=' + file] + command
+        return await self.git_command(['config'] + command, module)
+
+    async def list_branches(self, module=None):
+        """
+        List all local branches. If module is not 'None', list all branches
+        in that submodule.
+        """
+        res = (await self.git_command(['branch', '--no-color'], module)).splitlines()
+        branches = []
+        for branch in res:
+            branchname = branch.strip(' *')
+            if branchname != '(no branch)' and not branchname.startswith('(HEAD detached'):
+                branches.append(branchname)
+        return branches
+
+    async def remote_status(self, module, branch, limit=None, counts_only=False):
+        """
+        For the specified branch, lists the commits which are different between
+        the local and the tracked upstream version of that branch.
+
+        Returns a dictionary in the same form as GitSuperRepository.remote_status:
+        'only-upstream' and 'only-downstream' are lists of the commits, newest
+        first, as Commit objects, holding at most 'limit' commits each or none
+        if counts_only is True, and 'only-upstream-count' and
+        'only-downstream-count' are the numbers of them.
+        """
+        try:
+            remote = await self.config(['branch.'+branch+'.remote'], module)
+        except CalledProcessError:
+            # If the branch doesn't have a remote then return an empty list
+            return None
+
+        remote_ref = await self.config(['branch.'+branch+'.merge'], module)
+        upstream = remote + '/' + re.sub('^refs/heads/', '', remote_ref)
+
+        status = {'only-upstream' : [], 'only-downstream' : []}
+        counts = None
+        if counts_only or limit != None:
+            counts = (await self.git_command(['rev-list', '--count', '--left-right',
+                                              branch + '...' + upstream], module)).split()
+            counts = (int(counts[1]), int(counts[0]))
+            status['only-upstream-count']   = counts[0]
+            status['only-downstream-count'] = counts[1]
+            if counts_only:
+                return status
+
+        def enough(key, count):
+            return len(status[key]) >= min(limit, count)
+
+        # Read the commits a line at a time, stopping git once there are
+        # enough of them
+        loop = asyncio.get_event_loop()
+        (args, cwd) = await loop.run_in_executor(None, self.__repo.git_invocation,
+            ['rev-list', '--left-right', '--oneline', branch + '...' + upstream], module)
+        process = await asyncio.create_subprocess_exec(*args, cwd=cwd, stdout=PIPE)
+        seen = {'only-upstream' : 0, 'only-downstream' : 0}
+        finished = False
+        try:
+            while True:
+                line = (await process.stdout.readline()).decode('utf_8').rstrip('\n')
+                if line == '':
+                    finished = True
+                    break
+                key = 'only-upstream' if line[0] == '>' else 'only-downstream'
+                seen[key] += 1
+                if limit == None or len(status[key]) < limit:
+                    fields = line[1:].split(' ', 1)
+                    status[key].append(Commit(fields[0], fields[1] if len(fields) > 1 else ''))
+                if counts != None and enough('only-upstream', counts[0]) and \
+                   enough('only-downstream', counts[1]):
+                    break
+        finally:
+            if not finished:
+                kill(process)
+            await process.wait()
+        if finished and process.returncode != 0:
+            raise CalledProcessError(process.returncode, args)
+
+        if counts == None:
+            status['only-upstream-count']   = seen['only-upstream']
+            status['only-downstream-count'] = seen['only-downstream']
+        return status
+
+    async def fetch_module(self, module):
+        """Fetch a submodule from its remote with fetch_command."""
+        await self.git_command(self.__repo.fetch_command(module), module, stderr=STDOUT)
+
+    async def __for_modules(self, function, modules, jobs):
+        """
+        Await function(module) for each module, returning a dictionary mapping
+        each module for which it failed to the exception raised.
+        """
+        if jobs == None:
+            jobs = self.__jobs
+        results = await gather_limited(function, modules, jobs, return_exceptions=True)
+        errors = {}
+        for (module, result) in zip(modules, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                errors[module] = result
+        return errors
+
+    async def fetch_modules(self, modules, jobs=None):
+        """
+        Fetch a list of submodules from their remotes, running up to 'jobs'
+        fetches at once. Nothing is printed; instead a dictionary is returned
+        which maps each submodule which could not be fetched to the exception
+        raised.
+        """
+        return await self.__for_modules(self.fetch_module, modules, jobs)
+
+    async def checkout_modules(self, modules, jobs=None):
+        """
+        Checkout a list of submodules to the branches they should be tracking.
+        Returns a dictionary mapping each submodule which could not be checked
+        out to the exception raised.
+        """
+        async def checkout(module):
+            await self.git_command(['checkout', '-q', self.__repo.revision(module)],
+                                   module, stderr=STDOUT)
+        return await self.__for_modules(checkout, modules, jobs)
+
+    async def pull_ff(self, modules, jobs=None):
+        """
+        Do a fast-forward only pull of a list of submodules. Returns a
+        dictionary mapping each submodule which could not be updated to the
+        exception raised.
+        """
+        async def pull(module):
+            await self.git_command(['pull', '--ff-only', '-q'], module, stderr=STDOUT)
+        return await self.__for_modules(pull, modules, jobs)
@@ -0,0 +1,351 @@
+# GitModuleDaemon.py
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+=======================
+GitModuleDaemon Package
+=======================
+
+The GitModuleDaemon package lets git-module answer commands from a
+long-running process which keeps the state of a super-repository and its
+submodules in memory. The daemon listens on a Unix socket in the .git
+directory of the super-repository. Whenever that socket exists, git-module
+passes its command line to the daemon, and only runs the command itself if the
+daemon cannot be reached or does not handle that command.
+
+What the daemon remembers is forgotten as soon as anything it depends on
+changes: changes are noticed with inotify where it is available, and otherwise
+by comparing the modification times of the files involved.
+"""
+
+import sys, os
+import errno
+import json
+import socket
+import struct
+import threading
+
+from GitSuperRepository import GitSuperRepository
+
+SOCKET_NAME = 'git-module.sock'
+
+def socket_path(path):
+    """Get the daemon socket of the super-repository at path."""
+    return os.path.join(path, '.git', SOCKET_NAME)
+
+def find_socket(path):
+    """
+    Find the daemon socket of the super-repository containing path, searching
+    path and all of its parents in the same way as git-module. Returns None if
+    there is no super-repository, or no daemon is serving it.
+    """
+    path = os.path.abspath(path)
+    while True:
+        if os.path.isdir(os.path.join(path, '.git')) and \
+           os.path.isfile(os.path.join(path, '.gitmodules')):
+            if os.path.exists(socket_path(path)):
+                return socket_path(path)
+            return None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def send(connection, message):
+    """Send a message, encoded as a single line of JSON."""
+    connection.sendall((json.dumps(message) + '\n').encode('utf_8'))
+
+def receive(connection):
+    """Receive a message sent with send, or None if the connection closed."""
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data.decode('utf_8'))
+
+def request(socket_file, message):
+    """
+    Send a message to the daemon listening on socket_file and return its
+    reply, or None if the daemon could not be reached.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_file)
+        send(client, message)
+        return receive(client)
+    except socket.error:
+        return None
+    finally:
+        client.close()
+
+def run(socket_file, argv, cwd):
+    """
+    Ask the daemon listening on socket_file to run the git-module command
+    line argv from the directory cwd. Returns (status, output), or None if
+    the command should be run without the daemon.
+    """
+    reply = request(socket_file, {'argv' : argv, 'cwd' : cwd})
+    if reply == None or reply.get('fallback'):
+        return None
+    return (reply['status'], reply['output'])
+
+def stop(socket_file):
+    """Ask the daemon listening on socket_file to stop."""
+    return request(socket_file, {'stop' : True}) != None
+
+class StatWatcher():
+    """
+    Notice changes to directories by comparing the modification times and
+    sizes of the files in them. This is used where inotify is not available.
+    """
+    def __init__(self):
+        self.__paths      = {}
+        self.__signatures = {}
+
+    def __signature(self, paths):
+        signature = []
+        for (directory, recursive) in paths:
+            for (root, dirs, files) in os.walk(directory):
+                for name in files:
+                    try:
+                        st = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    signature.append((root, name, st.st_mtime, st.st_size, st.st_ino))
+                if not recursive:
+                    break
+        return signature
+
+    def watch(self, key, paths):
+        """
+        Start watching a list of (directory, recursive) pairs under key,
+        forgetting any changes seen for key before now.
+        """
+        self.__paths[key] = paths
+        self.__signatures[key] = self.__signature(paths)
+
+    def changed(self, key):
+        """Check whether anything watched under key has changed since last asked."""
+        if key not in self.__paths:
+            return True
+        signature = self.__signature(self.__paths[key])
+        if signature == self.__signatures[key]:
+            return False
+        self.__signatures[key] = signature
+        return True
+
+class InotifyWatcher():
+    """
+    Notice changes to directories using Linux inotify, so that checking for
+    changes costs no more than reading the pending events.
+    """
+    IN_MODIFY      = 0x00000002
+    IN_ATTRIB      = 0x00000004
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+           IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self):
+        """Create an inotify instance, raising OSError if that is not possible."""
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self.__add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.__add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.__fd = init(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.__watches = {}
+        self.__watched = set()
+        self.__changed = set()
+
+    def __add(self, key, directory, recursive):
+        for (root, dirs, files) in os.walk(directory):
+            wd = self.__add_watch(self.__fd, root.encode(sys.getfilesystemencoding()),
+                                  self.MASK)
+            if wd >= 0:
+                (path, keys) = self.__watches.setdefault(wd, (root, {}))
+                keys[key] = recursive
+            if not recursive:
+                break
+
+    def __read(self):
+        """Read all pending events, recording which keys have changed."""
+        while True:
+            try:
+                data = os.read(self.__fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16 : offset + 16 + length].rstrip(b'\0')
+                offset += 16 + length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    self.__changed.update(self.__watched)
+                if wd not in self.__watches:
+                    continue
+                (path, keys) = self.__watches[wd]
+                self.__changed.update(keys)
+                if mask & self.IN_IGNORED:
+                    del self.__watches[wd]
+                elif mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # Watch new directories inside recursively watched ones
+                    directory = os.path.join(path, name.decode(sys.getfilesystemencoding()))
+                    for (key, recursive) in list(keys.items()):
+                        if recursive:
+                            self.__add(key, directory, True)
+
+    def watch(self, key, paths):
+        """
+        Start watching a list of (directory, recursive) pairs under key,
+        forgetting any changes seen for key before now.
+        """
+        self.__read()
+        self.__changed.discard(key)
+        self.__watched.add(key)
+        for (directory, recursive) in paths:
+            self.__add(key, directory, recursive)
+
+    def changed(self, key):
+        """Check whether anything watched under key has changed since last asked."""
+        self.__read()
+        if key not in self.__watched or key in self.__changed:
+            self.__changed.discard(key)
+            return True
+        return False
+
+def make_watcher():
+    """Get an InotifyWatcher if inotify is available, and a StatWatcher otherwise."""
+    try:
+        return InotifyWatcher()
+    except OSError:
+        return StatWatcher()
+
+class WarmGitSuperRepository(GitSuperRepository):
+    """
+    A GitSuperRepository which keeps the status of the branches of each
+    submodule in memory until a watcher sees a change to the submodule's git
+    directory or refs, or to the .gitmodules file or index of the
+    super-repository. Call refresh before answering each request.
+    """
+    def __init__(self, path, watcher):
+        GitSuperRepository.__init__(self, path, persistent=True)
+        self.__watcher = watcher
+        self.__branch_status = {}
+        self.__lock = threading.Lock()
+        self.__watcher.watch(None, [(path, False), (self.module_git_dir(), False)])
+
+    def refresh(self):
+        """Forget anything which has changed since the last refresh."""
+        with self.__lock:
+            if self.__watcher.changed(None):
+                self.__branch_status = {}
+            for module in list(self.__branch_status):
+                if self.__watcher.changed(module):
+                    del self.__branch_status[module]
+
+    def branch_status(self, module=None, limit=None, counts_only=False):
+        """As for GitSuperRepository.branch_status, remembering the result."""
+        key = (limit, counts_only)
+        with self.__lock:
+            if key in self.__branch_status.get(module, {}):
+                return self.__branch_status[module][key]
+            if module not in self.__branch_status:
+                git_dir = self.module_git_dir(module)
+                self.__watcher.watch(module, [(git_dir, False),
+                                              (os.path.join(git_dir, 'refs'), True)])
+                self.__branch_status[module] = {}
+        status = GitSuperRepository.branch_status(self, module, limit, counts_only)
+        with self.__lock:
+            self.__branch_status.setdefault(module, {})[key] = status
+        return status
+
+class GitModuleDaemon():
+    """
+    Serve git-module commands over a Unix socket, one at a time. Each command
+    is handled by calling handler(argv, cwd), which returns (status, output),
+    or None if the client should run the command itself.
+    """
+    def __init__(self, socket_file, handler):
+        self.__socket_file = socket_file
+        self.__handler     = handler
+
+    def serve(self):
+        """Answer requests until a client asks the daemon to stop."""
+        if os.path.exists(self.__socket_file):
+            if request(self.__socket_file, {}) != None:
+                raise ValueError('Error: a daemon is already serving ' + self.__socket_file)
+            os.unlink(self.__socket_file)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.__socket_file)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+
+        try:
+            while True:
+                (connection, address) = server.accept()
+                try:
+                    message = receive(connection)
+                    if message == None:
+                        continue
+                    if message.get('stop'):
+                        send(connection, {'status' : 0, 'output' : ''})
+                        break
+                    if 'argv' not in message:
+                        send(connection, {'fallback' : True})
+                        continue
+                    result = self.__handler(message['argv'], message['cwd'])
+                    if result == None:
+                        send(connection, {'fallback' : True})
+                    else:
+                        send(connection, {'status' : result[0], 'output' : result[1]})
+                except (socket.error, ValueError):
+                    pass
+                except Exception:
+                    # A request which fails must not stop the daemon serving
+                    # other clients, so let the client run the command itself
+                    try:
+                        send(connection, {'fallback' : True})
+                    except socket.error:
+                        pass
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            if os.path.exists(self.__socket_file):
+                os.unlink(self.__socket_file)
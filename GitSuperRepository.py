@@ -29,8 +29,31 @@ including git, mercurial and svn.
 from __future__ import print_function
 
 import pprint, sys, os, re
+import errno
 import tempfile
-from subprocess import call, CalledProcessError
+import time
+import json
+import threading
+import shutil
+import hashlib
+import collections
+from subprocess import CalledProcessError, Popen, PIPE, STDOUT
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+# File locking is only available on Unix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # subprocess.check_output is only available in newer Python versions
 try:
@@ -40,59 +63,1184 @@ except ImportError:
         """Emulate the check_output function provided in newer versions of Python."""
         return subprocess.Popen(x, bufsize, executable, stdin, subprocess.PIPE, stderr, preexec_fn, close_fds, shell, cwd, env, universal_newlines, startupinfo, creationflags).communicate()[0]
 
+def parallel_map(function, items, jobs=1):
+    """
+    Apply function to each of items using a pool of up to 'jobs' worker
+    threads.
+
+    This is a generator which yields (item, result, exception) tuples in the
+    same order as items, each one as soon as it is available, so that progress
+    output based on them stays ordered. An exception raised by function is
+    yielded rather than raised so that one failing item does not prevent the
+    others from being processed.
+    """
+    items = list(items)
+    if jobs <= 1:
+        for item in items:
+            try:
+                yield (item, function(item), None)
+            except Exception as e:
+                yield (item, None, e)
+        return
+
+    results = [None] * len(items)
+    done = [threading.Event() for item in items]
+    pending = queue.Queue()
+    for i in range(len(items)):
+        pending.put(i)
+
+    # Workers may only run up to 'jobs' items ahead of the consumer, so that
+    # results which have not been yielded yet do not accumulate
+    window = threading.Semaphore(jobs)
+
+    def worker():
+        while True:
+            window.acquire()
+            try:
+                i = pending.get_nowait()
+            except queue.Empty:
+                window.release()
+                return
+            try:
+                results[i] = (items[i], function(items[i]), None)
+            except Exception as e:
+                results[i] = (items[i], None, e)
+            done[i].set()
+
+    threads = []
+    for n in range(min(jobs, len(items))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for i in range(len(items)):
+            done[i].wait()
+            result = results[i]
+            results[i] = None
+            window.release()
+            yield result
+    finally:
+        # Stop the workers picking up new items if we are interrupted, and
+        # wait for them to finish so that none is still running when the
+        # interpreter shuts down
+        try:
+            while True:
+                pending.get_nowait()
+        except queue.Empty:
+            pass
+        for thread in threads:
+            window.release()
+        for thread in threads:
+            thread.join()
+
+def error_output(error):
+    """Get a printable description of an exception returned by parallel_map."""
+    if isinstance(error, CalledProcessError) and error.output:
+        if isinstance(error.output, bytes):
+            return error.output.decode('utf_8', 'replace').rstrip('\n')
+        return error.output.rstrip('\n')
+    return str(error)
+
+class Tracer():
+    """
+    Records every child process started by a GitSuperRepository, with its
+    command line, submodule, start time, duration, exit status and the size of
+    its output, and produces reports from these records.
+    """
+    def __init__(self):
+        self.__lock    = threading.Lock()
+        self.__records = []
+
+    def record(self, args, module, start, duration, status, output_size):
+        """Record a child process."""
+        with self.__lock:
+            self.__records.append({'command' : args, 'module' : module,
+                'start' : start, 'duration' : duration, 'status' : status,
+                'output_size' : output_size,
+                'thread' : threading.current_thread().ident})
+
+    def records(self):
+        """Get a list of all of the recorded child processes."""
+        with self.__lock:
+            return list(self.__records)
+
+    def command_line(self, args):
+        """Get a readable command line, without --git-dir and --work-tree."""
+        return ' '.join([arg for arg in args if not arg.startswith('--git-dir=')
+                         and not arg.startswith('--work-tree=')])
+
+    def verb(self, args):
+        """Get the program and subcommand run by a command, such as 'git fetch'."""
+        i = 1
+        while i < len(args) and args[i].startswith('-'):
+            if args[i] in ('-c', '-C', '-R'):
+                i += 1
+            i += 1
+        program = os.path.basename(args[0])
+        if i < len(args):
+            return program + ' ' + args[i]
+        return program
+
+    def report(self, slowest=10):
+        """
+        Get a report ranking the total time spent in child processes for each
+        submodule and each git verb, followed by the slowest calls.
+        """
+        records = self.records()
+        lines = []
+        for (title, key) in (('submodule', lambda r: r['module'] or '(super-repository)'),
+                             ('command', lambda r: self.verb(r['command']))):
+            totals = {}
+            for r in records:
+                (duration, count) = totals.get(key(r), (0, 0))
+                totals[key(r)] = (duration + r['duration'], count + 1)
+            lines.append('Time per ' + title + ':')
+            for (name, (duration, count)) in sorted(totals.items(), key=lambda t: -t[1][0]):
+                lines.append('  %9.3fs %6d calls  %s' % (duration, count, name))
+
+        lines.append('Slowest calls:')
+        for r in sorted(records, key=lambda r: -r['duration'])[:slowest]:
+            lines.append('  %9.3fs  %s%s' % (r['duration'],
+                (r['module'] + ': ') if r['module'] else '', self.command_line(r['command'])))
+        total = sum([r['duration'] for r in records])
+        lines.append('%d child processes, %.3fs in total' % (len(records), total))
+        return '\n'.join(lines)
+
+    def write_chrome_trace(self, filename):
+        """
+        Write the records as a JSON trace file which can be loaded into Chrome's
+        about:tracing or other trace viewers.
+        """
+        events = []
+        for r in self.records():
+            events.append({'name' : self.verb(r['command']), 'cat' : 'process',
+                'ph' : 'X', 'pid' : os.getpid(), 'tid' : r['thread'],
+                'ts' : int(r['start'] * 1e6), 'dur' : int(r['duration'] * 1e6),
+                'args' : {'command' : self.command_line(r['command']),
+                          'module' : r['module'], 'status' : r['status'],
+                          'output_size' : r['output_size']}})
+        f = open(filename, 'w')
+        json.dump({'traceEvents' : events}, f)
+        f.close()
+
+class GitCatFile():
+    """
+    A long-lived 'git cat-file --batch' (or '--batch-check') process, used to
+    look up many objects in a repository without starting a new git process
+    for each one.
+    """
+    def __init__(self, args, cwd, check=False, tracer=None, module=None):
+        """
+        Start a cat-file process. 'args' is the start of a git command line
+        (such as the one given by GitSuperRepository.git_invocation) and 'cwd'
+        the directory to run it in. If check is True, only the type and size
+        of objects are looked up.
+
+        If a Tracer is given, the process is recorded with it when it is
+        closed, with the time spent on lookups as its duration.
+        """
+        batch = '--batch-check' if check else '--batch'
+        self.__check   = check
+        self.__lock    = threading.Lock()
+        self.__args    = args + ['cat-file', batch]
+        self.__tracer  = tracer
+        self.__module  = module
+        self.__start   = time.time()
+        self.__busy    = 0
+        self.__read    = 0
+        self.__process = Popen(self.__args, cwd=cwd, stdin=PIPE, stdout=PIPE)
+
+    def lookup(self, rev):
+        """
+        Look up an object. Returns a (sha1, type, content) tuple, where
+        content is None for a '--batch-check' process, or None if the object
+        does not exist.
+        """
+        with self.__lock:
+            start = time.time()
+            try:
+                self.__process.stdin.write(rev.encode('utf_8') + b'\n')
+                self.__process.stdin.flush()
+                header = self.__process.stdout.readline().decode('utf_8').rstrip('\n')
+                if header == '':
+                    raise CalledProcessError(self.__process.wait(), self.__args)
+                fields = header.split(' ')
+                if len(fields) != 3:
+                    # The object is missing or ambiguous
+                    return None
+                (sha1, type, size) = fields
+                content = None
+                if not self.__check:
+                    content = self.__process.stdout.read(int(size))
+                    self.__process.stdout.read(1)
+                    self.__read += int(size)
+                return (sha1, type, content)
+            finally:
+                self.__busy += time.time() - start
+
+    def close(self):
+        """Stop the cat-file process."""
+        with self.__lock:
+            self.__process.stdin.close()
+            self.__process.wait()
+            self.__process.stdout.close()
+            if self.__tracer != None:
+                self.__tracer.record(self.__args, self.__module, self.__start,
+                    self.__busy, self.__process.returncode, self.__read)
+
+class GitConfigFile():
+    """
+    An in-process model of a git configuration file, such as .gitmodules.
+
+    The file is parsed when it is first used and is only read again once its
+    modification time, size or inode change, so repeated lookups do not need
+    to start a git config process. Changes are held in memory until flush()
+    is called, which writes them all to the file atomically. Lines which have
+    not been changed, including comments, are written back as they were.
+    """
+    __escapes = {'n' : '\n', 't' : '\t', 'b' : '\b', '"' : '"', '\\' : '\\'}
+
+    def __init__(self, filename):
+        """Create a model of the configuration file 'filename'."""
+        self.__filename  = filename
+        self.__signature = None
+        self.__sections  = []
+        self.__dirty     = False
+        self.__lock      = threading.RLock()
+
+    def filename(self):
+        """Get the name of the configuration file."""
+        return self.__filename
+
+    def __file_signature(self):
+        try:
+            st = os.stat(self.__filename)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def __load(self):
+        """Parse the file again if it has changed since it was last read."""
+        if self.__dirty:
+            return
+        signature = self.__file_signature()
+        if signature == self.__signature and self.__sections:
+            return
+        text = ''
+        if signature != None:
+            f = open(self.__filename, 'rb')
+            text = f.read().decode('utf_8')
+            f.close()
+        self.__sections  = self.__parse(text)
+        self.__signature = signature
+
+    def __parse(self, text):
+        """
+        Parse the text of a configuration file into a list of sections. Each
+        section is a dictionary holding its name (lower case), subsection, the
+        raw text of its header and a list of entries. Each entry holds the
+        variable name (lower case and as written), its value and its raw text.
+        Comments and blank lines are kept as entries with no name.
+        """
+        section  = {'name' : None, 'subsection' : None, 'raw' : '', 'entries' : []}
+        sections = [section]
+        pos = 0
+        while pos < len(text):
+            start = pos
+            while pos < len(text) and text[pos] in ' \t\r':
+                pos += 1
+            if pos == len(text) or text[pos] in '\n#;':
+                # Blank line or comment
+                end = text.find('\n', pos)
+                pos = len(text) if end == -1 else end + 1
+                section['entries'].append({'key' : None, 'raw' : text[start:pos]})
+            elif text[pos] == '[':
+                (section, pos) = self.__parse_header(text, pos)
+                section['raw'] = text[start:pos]
+                sections.append(section)
+            else:
+                (entry, pos) = self.__parse_entry(text, pos)
+                entry['raw'] = text[start:pos]
+                section['entries'].append(entry)
+        return sections
+
+    def __parse_header(self, text, pos):
+        i = pos + 1
+        while i < len(text) and text[i] not in ' \t"]\n':
+            i += 1
+        name = text[pos + 1:i]
+        while i < len(text) and text[i] in ' \t':
+            i += 1
+        subsection = None
+        if i < len(text) and text[i] == '"':
+            subsection = ''
+            i += 1
+            while i < len(text) and text[i] not in '"\n':
+                if text[i] == '\\' and i + 1 < len(text):
+                    i += 1
+                subsection += text[i]
+                i += 1
+            i += 1
+        if i >= len(text) or text[i] != ']':
+            raise ValueError('Error: bad section header in ' + self.__filename)
+        if subsection == None and '.' in name:
+            # Deprecated [section.subsection] syntax
+            (name, subsection) = name.split('.', 1)
+            subsection = subsection.lower()
+        return ({'name' : name.lower(), 'subsection' : subsection, 'entries' : []}, i + 1)
+
+    def __parse_entry(self, text, pos):
+        start = pos
+        while pos < len(text) and (text[pos].isalnum() or text[pos] == '-'):
+            pos += 1
+        name = text[start:pos]
+        if name == '':
+            raise ValueError('Error: bad config line in ' + self.__filename)
+        while pos < len(text) and text[pos] in ' \t\r':
+            pos += 1
+        if pos == len(text) or text[pos] in '\n#;':
+            # A variable with no value is an implicit boolean true
+            end = text.find('\n', pos)
+            pos = len(text) if end == -1 else end + 1
+            return ({'key' : name.lower(), 'name' : name, 'value' : None}, pos)
+        if text[pos] != '=':
+            raise ValueError('Error: bad config line in ' + self.__filename)
+        pos += 1
+
+        value   = ''
+        spaces  = ''
+        quoted  = False
+        while pos < len(text):
+            c = text[pos]
+            pos += 1
+            if c == '\n':
+                break
+            elif c == '\\' and pos < len(text):
+                c = text[pos]
+                pos += 1
+                if c == '\n':
+                    # Line continuation
+                    continue
+                value += spaces + self.__escapes.get(c, c)
+                spaces = ''
+            elif c == '"':
+                value += spaces
+                spaces = ''
+                quoted = not quoted
+            elif not quoted and c in '#;':
+                end = text.find('\n', pos)
+                pos = len(text) if end == -1 else end + 1
+                break
+            elif not quoted and c in ' \t\r':
+                if value != '':
+                    spaces += c
+            else:
+                value += spaces + c
+                spaces = ''
+        return ({'key' : name.lower(), 'name' : name, 'value' : value}, pos)
+
+    def __quote(self, value):
+        escaped = value.replace('\\', '\\\\').replace('"', '\\"')
+        escaped = escaped.replace('\n', '\\n').replace('\t', '\\t').replace('\b', '\\b')
+        if value != value.strip() or '#' in value or ';' in value:
+            escaped = '"' + escaped + '"'
+        return escaped
+
+    def __find_sections(self, section, subsection):
+        section = section.lower()
+        return [s for s in self.__sections
+                if s['name'] == section and s['subsection'] == subsection]
+
+    def subsections(self, section):
+        """List the subsections of a section, in the order they appear."""
+        with self.__lock:
+            self.__load()
+            subsections = []
+            for s in self.__sections:
+                if s['name'] == section.lower() and s['subsection'] != None \
+                        and s['subsection'] not in subsections:
+                    subsections.append(s['subsection'])
+            return subsections
+
+    def options(self, section, subsection):
+        """Get a dictionary of all of the variables set in a (sub)section."""
+        with self.__lock:
+            self.__load()
+            options = {}
+            for s in self.__find_sections(section, subsection):
+                for entry in s['entries']:
+                    if entry['key'] != None:
+                        options[entry['key']] = 'true' if entry['value'] == None else entry['value']
+            return options
+
+    def get(self, section, subsection, key):
+        """Get the value of a variable, or None if it is not set."""
+        return self.options(section, subsection).get(key.lower())
+
+    def get_all(self, section, subsection, key):
+        """
+        Get a list of all of the values of a variable which may be set more
+        than once, such as remote.<name>.fetch, in the order they appear.
+        """
+        with self.__lock:
+            self.__load()
+            values = []
+            for s in self.__find_sections(section, subsection):
+                for entry in s['entries']:
+                    if entry['key'] == key.lower():
+                        values.append('true' if entry['value'] == None else entry['value'])
+            return values
+
+    def set(self, section, subsection, key, value):
+        """Set the value of a variable, adding its section if necessary."""
+        if not re.match(r'^[A-Za-z][A-Za-z0-9-]*$', key):
+            raise ValueError('Error: invalid key: ' + key)
+        if not re.match(r'^[A-Za-z0-9.-]+$', section):
+            raise ValueError('Error: invalid section: ' + section)
+        with self.__lock:
+            self.__load()
+            entry = {'key' : key.lower(), 'name' : key, 'value' : value, 'raw' : None}
+            sections = self.__find_sections(section, subsection)
+            for s in reversed(sections):
+                for (i, e) in reversed(list(enumerate(s['entries']))):
+                    if e['key'] == entry['key']:
+                        s['entries'][i] = entry
+                        self.__dirty = True
+                        return
+            if sections:
+                s = sections[-1]
+            else:
+                s = {'name' : section.lower(), 'subsection' : subsection,
+                     'raw' : None, 'section' : section, 'entries' : []}
+                self.__sections.append(s)
+            # Add the variable after the last one in the section, leaving any
+            # trailing comments or blank lines where they are
+            i = len(s['entries'])
+            while i > 0 and s['entries'][i - 1]['key'] == None:
+                i -= 1
+            s['entries'].insert(i, entry)
+            self.__dirty = True
+
+    def unset(self, section, subsection, key):
+        """Remove a variable."""
+        with self.__lock:
+            self.__load()
+            for s in self.__find_sections(section, subsection):
+                entries = [e for e in s['entries'] if e['key'] != key.lower()]
+                if len(entries) != len(s['entries']):
+                    s['entries'] = entries
+                    self.__dirty = True
+
+    def remove_section(self, section, subsection):
+        """Remove a (sub)section and all of the variables in it."""
+        with self.__lock:
+            self.__load()
+            sections = self.__find_sections(section, subsection)
+            if sections:
+                self.__sections = [s for s in self.__sections if s not in sections]
+                self.__dirty = True
+
+    def rename_section(self, section, subsection, new_subsection):
+        """Rename a subsection."""
+        with self.__lock:
+            self.__load()
+            for s in self.__find_sections(section, subsection):
+                s['subsection'] = new_subsection
+                s['section'] = section
+                s['raw'] = None
+                self.__dirty = True
+
+    def text(self):
+        """Get the text of the configuration file, including any changes."""
+        with self.__lock:
+            self.__load()
+            text = ''
+            for s in self.__sections:
+                if s['raw'] == None:
+                    if text != '' and not text.endswith('\n'):
+                        text += '\n'
+                    text += '[' + s['section']
+                    if s['subsection'] != None:
+                        text += ' "' + s['subsection'].replace('\\', '\\\\').replace('"', '\\"') + '"'
+                    text += ']'
+                else:
+                    text += s['raw']
+                for e in s['entries']:
+                    if e['raw'] == None:
+                        if text != '' and not text.endswith('\n'):
+                            text += '\n'
+                        text += '\t' + e['name']
+                        if e['value'] != None:
+                            text += ' = ' + self.__quote(e['value'])
+                        text += '\n'
+                    else:
+                        text += e['raw']
+            return text
+
+    def flush(self):
+        """Atomically write any changes to the file."""
+        with self.__lock:
+            if not self.__dirty:
+                return
+            text = self.text()
+            (f, name) = tempfile.mkstemp(dir=os.path.dirname(self.__filename),
+                                         prefix=os.path.basename(self.__filename) + '.')
+            try:
+                os.write(f, text.encode('utf_8'))
+                os.close(f)
+                if os.path.exists(self.__filename):
+                    shutil.copymode(self.__filename, name)
+                os.rename(name, self.__filename)
+            except:
+                if os.path.exists(name):
+                    os.remove(name)
+                raise
+            self.__dirty     = False
+            self.__signature = self.__file_signature()
+
+class Commit(object):
+    """
+    A commit listed by rev-list, with its abbreviated SHA1 and its title.
+    Using __slots__ keeps long lists of commits compact. A Commit can also be
+    read like the dictionary {'SHA1' : sha1, 'title' : title}, for example
+    with commit['title'] or dict(commit).
+    """
+    __slots__ = ('SHA1', 'title')
+
+    def __init__(self, sha1, title):
+        self.SHA1  = sha1
+        self.title = title
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, (Commit, Mapping)):
+            return NotImplemented
+        return dict(self) == dict(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class GitRefs():
+    """
+    Read-only access to the refs of a git repository, read straight from the
+    files in its git directory instead of by running git. Loose refs,
+    packed-refs and symbolic refs such as HEAD are understood, as is the
+    commondir file of linked worktrees. packed-refs is parsed when it is first
+    needed and is only read again once it changes. Repositories which store
+    their refs in the reftable format are not supported.
+    """
+    def __init__(self, git_dir):
+        """Create an object for reading the refs in the git directory git_dir."""
+        self.__git_dir    = git_dir
+        self.__common_dir = git_dir
+        self.__packed     = {}
+        self.__peeled     = {}
+        self.__packed_signature = None
+        self.__lock       = threading.Lock()
+        try:
+            f = open(os.path.join(git_dir, 'commondir'), 'r')
+            self.__common_dir = os.path.normpath(os.path.join(git_dir, f.read().strip()))
+            f.close()
+        except IOError:
+            pass
+
+    def common_dir(self):
+        """
+        Get the directory holding the refs, objects and configuration, which
+        is shared with any linked worktrees.
+        """
+        return self.__common_dir
+
+    def supported(self):
+        """Check that the refs are not stored in a format which cannot be read."""
+        return not os.path.isdir(os.path.join(self.__common_dir, 'reftable'))
+
+    def __packed_refs(self):
+        """
+        Get a pair of dictionaries, the first mapping each ref in packed-refs
+        to its value and the second mapping each annotated tag in it to the
+        object the tag points to.
+        """
+        filename = os.path.join(self.__common_dir, 'packed-refs')
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return ({}, {})
+        signature = (st.st_mtime, st.st_size, st.st_ino)
+        with self.__lock:
+            if signature != self.__packed_signature:
+                packed = {}
+                peeled = {}
+                name   = None
+                f = open(filename, 'r')
+                for line in f:
+                    if line.startswith('#'):
+                        continue
+                    # The peeled value of the tag on the previous line
+                    if line.startswith('^'):
+                        if name != None:
+                            peeled[name] = line[1:].strip()
+                        continue
+                    fields = line.rstrip('\n').split(' ', 1)
+                    if len(fields) == 2:
+                        name = fields[1]
+                        packed[name] = fields[0]
+                    else:
+                        name = None
+                f.close()
+                self.__packed = packed
+                self.__peeled = peeled
+                self.__packed_signature = signature
+            return (self.__packed, self.__peeled)
+
+    def __ref_file(self, name):
+        """Get the file in which a loose ref is stored."""
+        # HEAD and the other refs outside refs/ belong to a single worktree
+        if name.startswith('refs/') and not name.startswith('refs/worktree/') \
+           and not name.startswith('refs/bisect/'):
+            return os.path.join(self.__common_dir, name)
+        return os.path.join(self.__git_dir, name)
+
+    def read(self, name):
+        """
+        Get the value of a ref: either an object name, or 'ref: ' followed by
+        the name of another ref for a symbolic ref. Returns None if there is
+        no such ref, or if the file holding it does not contain either.
+        """
+        try:
+            f = open(self.__ref_file(name), 'rb')
+            value = f.readline(1024).decode('utf_8', 'replace').strip()
+            f.close()
+        except (IOError, OSError):
+            return self.__packed_refs()[0].get(name)
+        if re.match('^[0-9a-f]{40}([0-9a-f]{24})?$', value) or value.startswith('ref: '):
+            return value
+        return None
+
+    def resolve(self, name):
+        """
+        Get the object name a ref points to, following symbolic refs, or None
+        if there is no such ref.
+        """
+        for i in range(10):
+            value = self.read(name)
+            if value == None or not value.startswith('ref: '):
+                return value
+            name = value[len('ref: '):]
+        return None
+
+    def symbolic_ref(self, name='HEAD'):
+        """Get the ref a symbolic ref points to, or None if it is not symbolic."""
+        value = self.read(name)
+        if value == None or not value.startswith('ref: '):
+            return None
+        return value[len('ref: '):]
+
+    def peeled(self, name):
+        """
+        Get the object an annotated tag points to, if packed-refs records it
+        for the current value of the ref name, or None otherwise.
+        """
+        (packed, peeled) = self.__packed_refs()
+        sha1 = packed.get(name)
+        if sha1 == None or self.read(name) != sha1:
+            return None
+        return peeled.get(name)
+
+    def lookup(self, rev, peel=False):
+        """
+        Get the object name for rev, which may be a full object name or the
+        name of a ref abbreviated in any of the ways git allows, such as
+        'master' for refs/heads/master. If peel is True, annotated tags whose
+        target packed-refs records are replaced by that target. Returns None
+        if there is no such ref.
+        """
+        if re.match('^[0-9a-f]{40}([0-9a-f]{24})?$', rev):
+            return rev
+        for pattern in ('%s', 'refs/%s', 'refs/tags/%s', 'refs/heads/%s',
+                        'refs/remotes/%s', 'refs/remotes/%s/HEAD'):
+            # Outside refs/, git only looks for pseudo-refs such as FETCH_HEAD
+            if pattern == '%s' and not rev.startswith('refs/') and \
+               not re.match('^[A-Z_]+$', rev):
+                continue
+            name = pattern % rev
+            sha1 = self.resolve(name)
+            if sha1 != None:
+                if peel:
+                    return self.peeled(name) or sha1
+                return sha1
+        return None
+
+    def list(self, prefix='refs/'):
+        """
+        Get a dictionary mapping the name of every ref starting with prefix to
+        the object name it points to.
+        """
+        refs = {}
+        for (name, sha1) in self.__packed_refs()[0].items():
+            if name.startswith(prefix):
+                refs[name] = sha1
+        directory = os.path.join(self.__common_dir, prefix[:prefix.rfind('/') + 1])
+        for (root, dirs, files) in os.walk(directory):
+            for filename in files:
+                name = os.path.relpath(os.path.join(root, filename), self.__common_dir)
+                name = name.replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith('.lock'):
+                    sha1 = self.resolve(name)
+                    if sha1 != None:
+                        refs[name] = sha1
+        return refs
+
+class DivergenceCache():
+    """
+    A persistent cache of the commits which differ between pairs of commits,
+    kept as JSON in a file. Entries are keyed by the object names of the two
+    commits, so they never go out of date. Once the file would grow beyond
+    max_size bytes, the least recently used entries are dropped, and an entry
+    which on its own is larger than that is not stored at all. New entries are
+    held in memory until flush() is called, and looking an entry up never
+    writes the file. The cache is only an optimisation, so failing to write it
+    is not an error.
+    """
+    def __init__(self, filename, max_size=262144):
+        """Create a cache stored in 'filename' of at most max_size bytes."""
+        self.__filename  = filename
+        self.__max_size  = max_size
+        self.__entries   = collections.OrderedDict()
+        self.__pending   = collections.OrderedDict()
+        self.__signature = None
+        self.__lock      = threading.Lock()
+
+    def __entry_size(self, key, value):
+        return len(json.dumps([list(key), value])) + 2
+
+    def __load(self):
+        """Read the file again if another process has changed it."""
+        try:
+            st = os.stat(self.__filename)
+        except OSError:
+            return
+        signature = (st.st_mtime, st.st_size, st.st_ino)
+        if signature == self.__signature:
+            return
+        try:
+            f = open(self.__filename, 'r')
+            entries = json.load(f)
+            f.close()
+            self.__entries = collections.OrderedDict(
+                (tuple(key), value) for (key, value) in entries)
+        except (IOError, ValueError, TypeError):
+            self.__entries = collections.OrderedDict()
+        # Keep the entries which have not been written yet
+        for (key, value) in self.__pending.items():
+            self.__entries.pop(key, None)
+            self.__entries[key] = value
+        self.__signature = signature
+
+    def get(self, key):
+        """Get the value stored for a key, a tuple of strings, or None."""
+        with self.__lock:
+            self.__load()
+            if key not in self.__entries:
+                return None
+            # Mark it as the most recently used. This is only written to the
+            # file along with the next new entry.
+            value = self.__entries.pop(key)
+            self.__entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """
+        Store a value, which must be serialisable as JSON, for a key. The
+        value is written to the file by the next call to flush().
+        """
+        with self.__lock:
+            if self.__entry_size(key, value) > self.__max_size:
+                return
+            self.__load()
+            self.__entries.pop(key, None)
+            self.__entries[key] = value
+            self.__pending[key] = value
+
+    def flush(self):
+        """
+        Write any new entries to the file, oldest first, dropping the least
+        recently used ones to keep under the size limit.
+        """
+        with self.__lock:
+            if not self.__pending:
+                return
+            self.__pending = collections.OrderedDict()
+
+            sizes = [self.__entry_size(key, value) for (key, value) in self.__entries.items()]
+            total = sum(sizes)
+            for size in sizes[:-1]:
+                if total <= self.__max_size:
+                    break
+                self.__entries.popitem(last=False)
+                total -= size
+
+            directory = os.path.dirname(self.__filename)
+            try:
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                (fd, tmp) = tempfile.mkstemp(dir=directory, prefix='git-module-divergence.')
+            except OSError:
+                return
+            try:
+                os.write(fd, json.dumps([[list(key), value] for (key, value)
+                                         in self.__entries.items()]).encode('utf_8'))
+                os.close(fd)
+                os.rename(tmp, self.__filename)
+                st = os.stat(self.__filename)
+                self.__signature = (st.st_mtime, st.st_size, st.st_ino)
+            except OSError:
+                os.unlink(tmp)
+
 class GitSuperRepository():
     """
     Creating a GitSuperRepository object binds the object to a specific git
     repository.
     """
-    def __init__(self, path=None):
+    def __init__(self, path=None, persistent=False):
         """
         Create a GitSuperRepository object to manage a git repository.
 
         The root of the git repository is assumed to be 'path'. If this is not
         specified, then it is assumed to be the current working directory.
+
+        If persistent is True, object, tree and revision lookups are served by
+        long-lived git cat-file processes for the repository and each
+        submodule, which are kept open until close() is called.
         """
 
         self.__path    = path
         self.__git_dir = os.path.join(path, '.git')
         self.__dot_gitmodules = os.path.join(self.__path, '.gitmodules')
+        self.__gitmodules = GitConfigFile(self.__dot_gitmodules)
+        self.__persistent = persistent
+        self.__cat_files  = {}
+        self.__cat_files_lock = threading.Lock()
+        self.__gitlinks_lock  = threading.RLock()
+        self.__tracer = None
+        self.__index_gitlinks = None
+        self.__head_gitlinks  = None
+        self.__refs     = {}
+        self.__configs  = {}
+        self.__divergence_caches = {}
+        self.__refs_lock = threading.Lock()
+        self.__cache_dir = False
+        self.__cached_urls = set()
+        self.__fetch_overrides = {}
+        self.__init_state_lock = threading.Lock()
 
         # Check we have a git repository
         if not os.path.isdir(self.__git_dir) or \
            not os.path.isfile(self.__dot_gitmodules):
             raise ValueError(self.__git_dir + ' is not a git super-repository')
 
-    def __num_lines(self, test):
-        """Count the number of lines in a string."""
-        for i, l in enumerate(test.split('\n')):
-            pass
-        return i + 1
+    def set_tracer(self, tracer):
+        """
+        Record every child process started from now on with a Tracer, or stop
+        recording them if tracer is None.
+        """
+        self.__tracer = tracer
 
-    def git_command(self, command, module=None, exceptions=True):
-        """Execute a git command on the repository."""
+    def __trace(self, args, module, start, status, output_size):
+        """Record a child process with the tracer, if there is one."""
+        if self.__tracer != None:
+            self.__tracer.record(args, module, start, time.time() - start,
+                                 status, output_size)
+
+    def __check_output(self, args, module=None, cwd=None, stderr=None):
+        """Run a command with check_output, recording it with the tracer."""
+        start  = time.time()
+        status = None
+        output = b''
+        try:
+            output = check_output(args, cwd=cwd, stderr=stderr)
+            status = 0
+            return output
+        except CalledProcessError as e:
+            status = e.returncode
+            output = e.output or b''
+            raise
+        finally:
+            self.__trace(args, module, start, status, len(output))
+
+    def git_invocation(self, command, module=None):
+        """
+        Get the argument list and working directory used to run a git command
+        on the repository, or on a submodule if module is not 'None'.
+        """
         if module == None:
-            git_dir   = '--git-dir=' + self.__git_dir
-            work_tree = '--work-tree=' + self.__path
-            if exceptions:
-                return check_output(['git', git_dir, work_tree] + command, cwd=self.__path).decode('utf_8').rstrip('\n')
-            else:
-                try:
-                    output = check_output(['git', git_dir, work_tree] + command, cwd=self.__path).decode('utf_8').rstrip('\n')
-                except CalledProcessError as e:
-                    print(e.output, end='')
+            path    = self.__path
+            git_dir = self.__git_dir
         else:
             self.assert_is_submodule(module)
-            module_abspath =  os.path.join(self.__path, module)
-            git_dir   = '--git-dir=' + os.path.join(module_abspath, '.git')
-            work_tree = '--work-tree=' + module_abspath
-            if exceptions:
-                # TODO: find a better way of dealing with weird characters
-                return check_output(['git', git_dir, work_tree] + command, cwd=module_abspath).decode('utf_8').rstrip('\n')
+            path    = os.path.join(self.__path, module)
+            git_dir = os.path.join(path, '.git')
+        return (['git', '--git-dir=' + git_dir, '--work-tree=' + path] + command, path)
+
+    def module_git_dir(self, module=None):
+        """
+        Get the git directory of the repository, or of a submodule if module
+        is not 'None'. A submodule's .git may be a file pointing to its git
+        directory inside that of the super-repository.
+        """
+        if module == None:
+            return self.__git_dir
+        git_dir = os.path.join(self.__path, module, '.git')
+        if os.path.isfile(git_dir):
+            f = open(git_dir, 'r')
+            line = f.readline().strip()
+            f.close()
+            if line.startswith('gitdir: '):
+                git_dir = os.path.join(os.path.dirname(git_dir), line[len('gitdir: '):])
+        return os.path.normpath(git_dir)
+
+    def refs(self, module=None):
+        """
+        Get a GitRefs object for reading the refs of the repository, or of a
+        submodule if module is not 'None', without running git.
+        """
+        git_dir = self.module_git_dir(module)
+        with self.__refs_lock:
+            if git_dir not in self.__refs:
+                self.__refs[git_dir] = GitRefs(git_dir)
+            return self.__refs[git_dir]
+
+    def __readable_refs(self, module):
+        """
+        Get the GitRefs object for a module if its refs can be read from disk,
+        or None if git has to be asked instead.
+        """
+        refs = self.refs(module)
+        if refs.supported() and refs.read('HEAD') != None:
+            return refs
+        return None
+
+    def __module_config(self, module):
+        """Get a GitConfigFile for the git configuration of a module."""
+        filename = os.path.join(self.refs(module).common_dir(), 'config')
+        with self.__refs_lock:
+            if filename not in self.__configs:
+                self.__configs[filename] = GitConfigFile(filename)
+            return self.__configs[filename]
+
+    def divergence_cache(self, module=None):
+        """
+        Get the DivergenceCache for the repository, or for a submodule if
+        module is not 'None'. The caches are kept in .git/git-module of the
+        super-repository, named after a hash of the submodule's name, rather
+        than in the git directories of the submodules, so that writing them
+        does not look like a change to a submodule to anything watching it.
+        """
+        name = hashlib.sha1((module or '').encode('utf_8')).hexdigest()
+        filename = os.path.join(self.__git_dir, 'git-module', 'divergence', name)
+        with self.__refs_lock:
+            if filename not in self.__divergence_caches:
+                self.__divergence_caches[filename] = DivergenceCache(filename)
+            return self.__divergence_caches[filename]
+
+    def __tracked_branches(self, refs, module):
+        """
+        List the (branch, upstream) refs of every local branch which tracks an
+        upstream branch, reading them from disk. Returns None if the upstream
+        of a branch cannot be worked out from the refspecs of its remote, in
+        which case git has to be asked instead.
+        """
+        config = self.__module_config(module)
+        branches = []
+        for name in sorted(refs.list('refs/heads/')):
+            branch = name[len('refs/heads/'):]
+            remote = config.get('branch', branch, 'remote')
+            merge  = config.get('branch', branch, 'merge')
+            if remote == None or merge == None:
+                continue
+            if remote == '.':
+                upstream = merge
             else:
-                try:
-                    output = check_output(['git', git_dir, work_tree] + command, cwd=module_abspath).decode('utf_8').rstrip('\n')
-                except CalledProcessError as e:
-                    print(e.output, end='')
+                # Map the merge ref to a remote-tracking ref with the first of
+                # the remote's refspecs which matches it
+                upstream = None
+                for refspec in config.get_all('remote', remote, 'fetch'):
+                    if refspec.startswith('^') or ':' not in refspec:
+                        continue
+                    (src, dst) = refspec.lstrip('+').split(':', 1)
+                    if '*' in src and '*' in dst:
+                        (prefix, suffix) = src.split('*', 1)
+                        if merge.startswith(prefix) and merge.endswith(suffix) and \
+                           len(merge) >= len(prefix) + len(suffix):
+                            upstream = dst.replace('*', merge[len(prefix):len(merge) - len(suffix)], 1)
+                            break
+                    elif src == merge:
+                        upstream = dst
+                        break
+                if upstream == None:
+                    return None
+            branches.append((name, upstream))
+        return branches
+
+    def head(self, module=None):
+        """
+        Get the commit checked out in the repository, or in a submodule if
+        module is not 'None'. This is read from disk where possible.
+        """
+        refs = self.__readable_refs(module)
+        if refs != None:
+            return refs.resolve('HEAD')
+        return self.git_command(['rev-parse', 'HEAD'], module)
+
+    def git_command(self, command, module=None, exceptions=True, stderr=None):
+        """Execute a git command on the repository."""
+        (args, cwd) = self.git_invocation(command, module)
+        if exceptions:
+            # TODO: find a better way of dealing with weird characters
+            return self.__check_output(args, module, cwd, stderr).decode('utf_8').rstrip('\n')
+        else:
+            try:
+                output = self.__check_output(args, module, cwd, stderr).decode('utf_8').rstrip('\n')
+            except CalledProcessError as e:
+                print(e.output, end='')
+
+    def __cat_file(self, module, check):
+        """Get the cat-file process used for looking up objects in a module."""
+        if not self.__persistent:
+            return GitCatFile(*self.git_invocation([], module), check=check,
+                              tracer=self.__tracer, module=module)
+        with self.__cat_files_lock:
+            key = (module, check)
+            if key not in self.__cat_files:
+                self.__cat_files[key] = GitCatFile(*self.git_invocation([], module),
+                    check=check, tracer=self.__tracer, module=module)
+            return self.__cat_files[key]
+
+    def __lookup_object(self, rev, module, check):
+        """Look up an object using a cat-file process."""
+        cat_file = self.__cat_file(module, check)
+        try:
+            return cat_file.lookup(rev)
+        finally:
+            if not self.__persistent:
+                cat_file.close()
+
+    def close(self):
+        """Stop any persistent git processes used by the repository."""
+        with self.__cat_files_lock:
+            for cat_file in self.__cat_files.values():
+                cat_file.close()
+            self.__cat_files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def rev_parse(self, rev, module=None):
+        """
+        Get the SHA1 of the object named by rev, or None if there is no such
+        object.
+        """
+        object = self.__lookup_object(rev, module, check=True)
+        if object == None:
+            return None
+        return object[0]
+
+    def cat_object(self, rev, module=None):
+        """
+        Read the object named by rev. Returns a (sha1, type, content) tuple,
+        with content as a byte string, or None if there is no such object.
+        """
+        return self.__lookup_object(rev, module, check=False)
+
+    def tree_entry(self, rev, path, module=None):
+        """
+        Look up the entry for path in the tree of the commit rev. Returns a
+        (mode, sha1) tuple, or None if there is no such entry. Unlike rev_parse
+        this also works for submodules, whose commits are not objects in the
+        repository.
+        """
+        (dirname, basename) = os.path.split(path.rstrip('/'))
+        if dirname == '':
+            tree = self.cat_object(rev + '^{tree}', module)
+        else:
+            tree = self.cat_object(rev + ':' + dirname, module)
+        if tree == None or tree[1] != 'tree':
+            return None
+
+        # Each tree entry is '<mode> <name>\0' followed by the binary SHA1
+        content = tree[2]
+        hash_length = len(tree[0]) // 2
+        name = basename.encode('utf_8')
+        i = 0
+        while i < len(content):
+            nul = content.index(b'\0', i)
+            (mode, entry) = content[i:nul].split(b' ', 1)
+            i = nul + 1 + hash_length
+            if entry == name:
+                sha1 = ''.join(['%02x' % c for c in bytearray(content[nul + 1:i])])
+                return (mode.decode('utf_8'), sha1)
+        return None
+
+    def git_input(self, command, input, module=None):
+        """Execute a git command on the repository, passing input to its stdin."""
+        (args, cwd) = self.git_invocation(command, module)
+        start = time.time()
+        process = Popen(args, cwd=cwd, stdin=PIPE, stdout=PIPE)
+        output = process.communicate(input.encode('utf_8'))[0]
+        self.__trace(args, module, start, process.returncode, len(output))
+        if process.returncode != 0:
+            raise CalledProcessError(process.returncode, args, output)
+        return output.decode('utf_8').rstrip('\n')
+
+    def git_stream(self, command, module=None, separator=b'\0'):
+        """
+        Execute a git command on the repository and iterate over its output as
+        it is produced, split into the pieces delimited by 'separator'. This
+        avoids holding the whole output of commands such as log in memory.
+        """
+        (args, cwd) = self.git_invocation(command, module)
+        start = time.time()
+        process = Popen(args, cwd=cwd, stdout=PIPE)
+        finished = False
+        size = 0
+        try:
+            remainder = b''
+            for chunk in iter(lambda: process.stdout.read(65536), b''):
+                size += len(chunk)
+                pieces = (remainder + chunk).split(separator)
+                remainder = pieces.pop()
+                for piece in pieces:
+                    yield piece.decode('utf_8')
+            if remainder:
+                yield remainder.decode('utf_8')
+            finished = True
+        finally:
+            process.stdout.close()
+            if not finished:
+                # The caller stopped iterating early, so git is no longer needed
+                process.kill()
+            process.wait()
+            self.__trace(args, module, start, process.returncode, size)
+        if process.returncode != 0:
+            raise CalledProcessError(process.returncode, args)
 
     def config(self, command, module=None, file=None):
         """Configure the repository."""
@@ -102,24 +1250,82 @@ class GitSuperRepository():
 
     def get_gitmodules_config(self, module, option):
         """Get a gitmodules configuration option for a submodule."""
-        return self.config(['submodule.' + module + '.' + option],
-                            file=self.__dot_gitmodules)
+        name  = 'submodule.' + module + '.' + option
+        value = self.__gitmodules.get('submodule', module, option)
+        if value == None:
+            # Raise the same error as git config does for an unset option
+            raise CalledProcessError(1, ['git', 'config', '--file', '.gitmodules', name],
+                                     'Error: ' + name + ' is not set in .gitmodules.')
+        return value
+
+    def set_gitmodules_config(self, module, option, value, flush=True):
+        """
+        Set a gitmodules configuration option for a submodule. If flush is
+        False, the change is only written to .gitmodules by a later call to
+        flush_gitmodules, so that several changes can be written at once.
+        """
+        self.__gitmodules.set('submodule', module, option, value)
+        if flush:
+            self.flush_gitmodules()
 
-    def set_gitmodules_config(self, module, option, value):
-        """Set a gitmodules configuration option for a submodule."""
-        return self.config(['submodule.' + module + '.' + option, value],
-                            file=self.__dot_gitmodules)
+    def flush_gitmodules(self):
+        """Atomically write any pending changes to .gitmodules."""
+        self.__gitmodules.flush()
+
+    def __index_signature(self):
+        try:
+            st = os.stat(os.path.join(self.__git_dir, 'index'))
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def submodule_index(self):
+        """
+        Get a dictionary mapping the path of each submodule in the index to the
+        commit recorded for it there. This is read with a single git ls-files
+        command and cached until the index file changes.
+        """
+        with self.__gitlinks_lock:
+            signature = self.__index_signature()
+            if self.__index_gitlinks == None or self.__index_gitlinks[0] != signature:
+                gitlinks = {}
+                for entry in self.git_stream(['ls-files', '--stage', '-z']):
+                    (info, path) = entry.split('\t', 1)
+                    (mode, sha1, stage) = info.split(' ')
+                    # Unmerged submodules are not considered to be submodules
+                    if mode == '160000' and stage == '0':
+                        gitlinks[path] = sha1
+                self.__index_gitlinks = (signature, gitlinks)
+            return self.__index_gitlinks[1]
+
+    def submodule_head(self):
+        """
+        Get a dictionary mapping the path of each submodule in the index to the
+        commit recorded for it in HEAD, if any. This is read with a single
+        git ls-tree command and cached until HEAD or the index change.
+        """
+        with self.__gitlinks_lock:
+            index = self.submodule_index()
+            refs = self.__readable_refs(None)
+            if refs != None:
+                head = refs.resolve('HEAD')
+            else:
+                head = self.rev_parse('HEAD^{commit}')
+            key = (self.__index_gitlinks[0], head)
+            if self.__head_gitlinks == None or self.__head_gitlinks[0] != key:
+                gitlinks = {}
+                if key[1] != None and index:
+                    for entry in self.git_stream(['ls-tree', '-z', key[1], '--'] + sorted(index)):
+                        (info, path) = entry.split('\t', 1)
+                        (mode, type, sha1) = info.split(' ')
+                        if mode == '160000':
+                            gitlinks[path] = sha1
+                self.__head_gitlinks = (key, gitlinks)
+            return self.__head_gitlinks[1]
 
     def is_submodule(self, path):
         """Check if path is a submodule."""
-        output = self.git_command(['ls-files', '--stage', '--', path])
-
-        if(self.__num_lines(output) != 1):
-            return False
-        if output[0:6] == '160000':
-            return True
-        else:
-            return False
+        return os.path.normpath(path) in self.submodule_index()
 
     def assert_is_submodule(self, path):
         """Raise an exception if path is not a valid submodule."""
@@ -138,57 +1344,221 @@ class GitSuperRepository():
         """Get branch of upstream repository which should be tracked by a submodule."""
         return self.get_gitmodules_config(path, 'revision')
 
-    def set_upstream_type(self, path, type):
+    def set_upstream_type(self, path, type, flush=True):
         """Set version control system used by upstream repository."""
-        self.set_gitmodules_config(path, 'upstreamtype', type)
+        self.set_gitmodules_config(path, 'upstreamtype', type, flush)
 
-    def set_upstream_url(self, path, url):
+    def set_upstream_url(self, path, url, flush=True):
         """Set URL of upstream repository."""
-        self.set_gitmodules_config(path, 'upstreamurl', url)
+        self.set_gitmodules_config(path, 'upstreamurl', url, flush)
 
-    def set_revision(self, path, revision):
+    def set_revision(self, path, revision, flush=True):
         """Set branch of upstream repository which should be tracked by a submodule."""
-        self.set_gitmodules_config(path, 'revision', revision)
+        self.set_gitmodules_config(path, 'revision', revision, flush)
+
+    def submodule_state(self, module):
+        """
+        Compare what is checked out in a submodule with the revision it tracks.
+        Returns a dictionary of 'module', 'revision', 'branch', 'SHA1' and a
+        'status' of 'on-revision', 'other-branch', 'detached', 'no-revision',
+        'missing' or 'unreadable'.
+        """
+        try:
+            revision = self.revision(module)
+        except CalledProcessError:
+            revision = None
+        refs   = self.refs(module)
+        sha1   = refs.resolve('HEAD')
+        branch = refs.symbolic_ref('HEAD')
+        if branch != None:
+            branch = re.sub('^refs/heads/', '', branch)
+
+        if not refs.supported():
+            status = 'unreadable'
+        elif sha1 == None:
+            status = 'missing'
+        elif revision == None:
+            status = 'no-revision'
+        elif branch == revision:
+            status = 'on-revision'
+        elif branch == None and refs.resolve('refs/heads/' + revision) == None \
+             and self.__revision_commit(refs, module, revision, sha1) == sha1:
+            # A tag or commit, rather than a branch, is being tracked
+            status = 'on-revision'
+        elif branch != None:
+            status = 'other-branch'
+        else:
+            status = 'detached'
+        return {'module' : module, 'revision' : revision, 'branch' : branch,
+                'SHA1' : sha1, 'status' : status}
+
+    def __revision_commit(self, refs, module, revision, head):
+        """
+        Get the commit named by the tag or commit a submodule tracks, only
+        asking git when it may be an annotated tag which does not match head.
+        """
+        commit = refs.lookup(revision, peel=True)
+        if commit != None and commit != head \
+           and commit == refs.resolve('refs/tags/' + revision):
+            # Only packed-refs records the commits annotated tags point to
+            try:
+                commit = self.rev_parse(revision + '^{commit}', module) or commit
+            except CalledProcessError:
+                pass
+        return commit
 
-    def upstream_init(self, path):
-        """Initialise a submodule for pushing patches upstream."""
+    def __upstream_init_steps(self, path, type, url, previous):
+        """
+        Get the list of (name, function) steps which initialise the upstream
+        repository of a submodule of the given type. previous is the state
+        recorded for the submodule before this run, or None.
+        """
+        module_path = os.path.join(self.__path, path)
+        hgpath = module_path + '.hg'
+
+        def run(args):
+            return lambda: self.__check_output(args, path, cwd=self.__path, stderr=STDOUT)
+
+        def git(command):
+            return lambda: self.git_command(command, module=path, stderr=STDOUT)
+
+        def hg_clone():
+            if os.path.exists(hgpath):
+                # Only start again from scratch if the clone there is one which
+                # an earlier run started but did not finish
+                if previous == None or previous.get('started') != 'hg-clone' or \
+                   previous.get('url') != url:
+                    raise ValueError('Error: ' + hgpath + ' already exists. Move it '
+                                     'out of the way to initialise ' + path + ' again.')
+                shutil.rmtree(hgpath)
+            # Record that the clone is ours before starting it, so that it can
+            # be removed if it is interrupted
+            self.__write_upstream_init_state(path, {'type' : type, 'url' : url,
+                                                    'steps' : [], 'started' : 'hg-clone'})
+            self.__check_output(['hg', 'clone', url, hgpath], path, cwd=self.__path,
+                                stderr=STDOUT)
+
+        def hgrc():
+            hgrc = open(os.path.join(hgpath, '.hg', 'hgrc'), 'a')
+            hgrc.write('\n[paths]\ngit = ' + module_path + '\n\n[git]\nintree = 1\n')
+            hgrc.close()
+
+        if type == 'svn':
+            return [('checkout', git(['checkout', '-q', self.revision(path)])),
+                    ('svn-init', git(['svn', 'init', '-s', '--prefix=origin/', url])),
+                    ('svn-fetch', git(['svn', 'fetch']))]
+        elif type == 'git':
+            return [('push-url', git(['remote', 'set-url', '--push', 'origin', url]))]
+        elif type == 'hg':
+            return [('hg-clone', hg_clone),
+                    ('hgrc', hgrc),
+                    ('bookmark', run(['hg', '-R', hgpath, 'bookmark', 'master', '-r', 'default'])),
+                    ('gexport', run(['hg', '-R', hgpath, 'gexport'])),
+                    ('pull', run(['hg', '-R', hgpath, 'pull', 'git']))]
+        raise ValueError('Error: unknown upstream repository type ' + type + ' for ' + path + '.')
+
+    def upstream_init_state_file(self):
+        """
+        Get the name of the file in which upstream_init records the steps it
+        has completed for each submodule.
+        """
+        return os.path.join(self.__git_dir, 'git-module-upstream-init')
+
+    def __read_upstream_init_state(self):
+        try:
+            f = open(self.upstream_init_state_file(), 'r')
+        except IOError:
+            return {}
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+        finally:
+            f.close()
+
+    def __write_upstream_init_state(self, path, entry):
+        """Atomically record the state of a submodule, or forget it if entry is None."""
+        with self.__init_state_lock:
+            state = self.__read_upstream_init_state()
+            if entry == None:
+                state.pop(path, None)
+            else:
+                state[path] = entry
+            (fd, tmp) = tempfile.mkstemp(dir=self.__git_dir, prefix='git-module-upstream-init.')
+            try:
+                os.write(fd, json.dumps(state, indent=1, sort_keys=True).encode('utf_8'))
+                os.close(fd)
+                os.rename(tmp, self.upstream_init_state_file())
+            except:
+                os.unlink(tmp)
+                raise
+
+    def upstream_init(self, path, restart=False):
+        """
+        Initialise a submodule for pushing patches upstream.
+
+        Each step is recorded in the file given by upstream_init_state_file
+        as soon as it has completed, so that if the initialisation is
+        interrupted or fails it carries on from where it stopped the next
+        time, unless restart is True. Steps are only skipped if the upstream
+        type and URL are the same as when they were done. Returns 'initialised',
+        'resumed' or 'unchanged' if every step had already been done. Error
+        output is captured in the exception raised if a step fails.
+        """
         self.assert_is_submodule(path)
 
         path = path.rstrip('/')
         type = self.upstream_type(path)
         url  = self.upstream_url(path)
 
-        print('Initialising submodule ' + type + ' upstream repository for ' + path + '\nwith upstream URL ' + url)
+        done = []
+        with self.__init_state_lock:
+            entry = self.__read_upstream_init_state().get(path)
+        if not restart and entry != None and entry.get('type') == type and \
+           entry.get('url') == url:
+            done = entry.get('steps', [])
+        steps = self.__upstream_init_steps(path, type, url, entry)
 
-        if type == 'svn':
-            rev = self.revision(path)
-            self.git_command(['checkout', rev], module=path)
-            self.git_command(['svn', 'init', '-s', '--prefix=origin/', url], module=path)
-            self.git_command(['svn', 'fetch'], module=path)
-        elif type == 'git':
-            self.git_command(['remote', 'set-url', '--push', 'origin', url], module=path)
-        elif type == 'hg':
-            hgpath = path+'.hg'
-            call(['hg', 'clone', url, hgpath])
-            hgrc = open(os.path.join(hgpath,'.hg/hgrc'), 'a')
-            hgrc.write('\n[path]\ngit = '+path+'\n\n[git]\nintree = 1\n')
-            hgrc.close()
-            call(['hg', '-R', hgpath, 'bookmark', 'master', '-r', 'default'])
-            call(['hg', '-R', hgpath, 'gexport'])
-            call(['hg', '-R', hgpath, 'pull', 'git'])
-        else:
-            print('Unknown upstream repository type: ' + type)
-        return
+        status = 'unchanged'
+        for (name, step) in steps:
+            if name in done:
+                continue
+            if status == 'unchanged':
+                status = 'resumed' if done else 'initialised'
+            step()
+            done = done + [name]
+            self.__write_upstream_init_state(path, {'type' : type, 'url' : url,
+                                                    'steps' : done})
+        return status
+
+    def upstream_init_modules(self, modules, jobs=1, restart=False):
+        """
+        Initialise a list of submodules for pushing patches upstream with
+        upstream_init, running up to 'jobs' of them at once. Returns a
+        dictionary mapping each submodule which could not be initialised to
+        the error output.
+        """
+        print('Initialising upstream repositories:')
+        errors = {}
+        for (module, status, error) in parallel_map(
+                lambda module: self.upstream_init(module, restart), modules, jobs):
+            if error != None:
+                status = 'failed'
+                errors[module] = error_output(error)
+            print('  ' + module + ': ' + status)
+
+        self.__print_errors('initialise', modules, errors)
+        return errors
 
     def mv_submodule(self, old, new):
         """Move a submodule."""
         self.assert_is_submodule(old)
 
         self.config(['--rename-section', 'submodule.'+old, 'submodule.'+new])
-        self.config(['--rename-section', 'submodule.'+old, 'submodule.'+new],
-            file=self.__dot_gitmodules)
-        self.config(['submodule.'+new+'.path', new], file=self.__dot_gitmodules)
+        self.__gitmodules.rename_section('submodule', old, new)
+        self.set_gitmodules_config(new, 'path', new, flush=False)
         self.git_command(['rm', '--cached', old])
+        self.flush_gitmodules()
         os.rename(old, new)
         self.git_command(['add', new])
         self.git_command(['add', self.__dot_gitmodules])
@@ -197,38 +1567,185 @@ class GitSuperRepository():
         """Remove a submodule."""
         self.assert_is_submodule(old)
         self.config(['--remove-section', 'submodule.'+old])
-        self.config(['--remove-section', 'submodule.'+old],
-            file=self.__dot_gitmodules)
+        self.__gitmodules.remove_section('submodule', old)
         self.git_command(['rm', '--cached', old])
+        self.flush_gitmodules()
         self.git_command(['add', self.__dot_gitmodules])
 
+    def object_cache_dir(self):
+        """
+        Get the directory of the shared object cache, which is given by the
+        GIT_MODULE_CACHE_DIR environment variable or else by the module.cachedir
+        git configuration variable, relative to the root of the repository.
+        Returns None if neither is set.
+        """
+        if self.__cache_dir == False:
+            cache_dir = os.environ.get('GIT_MODULE_CACHE_DIR')
+            if not cache_dir:
+                try:
+                    cache_dir = self.config(['--get', 'module.cachedir'])
+                except CalledProcessError:
+                    cache_dir = None
+            if cache_dir:
+                cache_dir = os.path.join(self.__path, os.path.expanduser(cache_dir))
+                cache_dir = os.path.normpath(cache_dir)
+            else:
+                cache_dir = None
+            self.__cache_dir = cache_dir
+        return self.__cache_dir
+
+    def cache_repository(self, url):
+        """
+        Get an up to date bare mirror of the repository at url from the shared
+        object cache, to be used with git clone --reference, or None if there
+        is no cache or url is relative.
+        """
+        cache_dir = self.object_cache_dir()
+        if cache_dir == None or url.startswith('./') or url.startswith('../'):
+            return None
+
+        name = re.sub('[^A-Za-z0-9._-]+', '_', url)[-64:]
+        name += '-' + hashlib.sha1(url.encode('utf_8')).hexdigest()[:12]
+        mirror = os.path.join(cache_dir, name + '.git')
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            # It may exist already, or another clone may have just created it
+            if e.errno != errno.EEXIST or not os.path.isdir(cache_dir):
+                raise
+
+        lock = open(mirror + '.lock', 'w')
+        try:
+            if fcntl != None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.isdir(mirror):
+                tmp = tempfile.mkdtemp(dir=cache_dir, prefix=name + '.tmp-')
+                try:
+                    self.__check_output(['git', 'clone', '-q', '--mirror', url, tmp],
+                                        cwd=cache_dir, stderr=STDOUT)
+                    self.__check_output(['git', '--git-dir=' + tmp, 'config',
+                                         'gc.pruneExpire', 'never'])
+                    os.rename(tmp, mirror)
+                except:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    raise
+            elif url not in self.__cached_urls:
+                self.__check_output(['git', '--git-dir=' + mirror, 'fetch', '-q', url,
+                                     '+refs/*:refs/*'], stderr=STDOUT)
+            self.__cached_urls.add(url)
+        finally:
+            lock.close()
+        return mirror
+
+    def __reference(self, url):
+        """Get the options for git clone to borrow objects from the cache."""
+        mirror = self.cache_repository(url)
+        if mirror == None:
+            return []
+        return ['--reference', mirror]
+
+    def clone_modules(self, modules, jobs=1):
+        """
+        Clone the submodules in a list which are not checked out yet, up to
+        'jobs' at once. Returns the error output for each submodule which
+        could not be cloned.
+        """
+        modules = [module for module in modules if self.refs(module).read('HEAD') == None]
+        print('Cloning submodules:')
+        if modules:
+            # Register them all at once, as git submodule init writes .git/config
+            self.git_command(['submodule', 'init', '-q', '--'] + modules, stderr=STDOUT)
+
+        def clone(module):
+            url = self.__module_config(None).get('submodule', module, 'url') or \
+                  self.get_gitmodules_config(module, 'url')
+            if os.path.exists(os.path.join(self.__git_dir, 'modules', module)):
+                # Let git reuse the git directory of an earlier clone
+                self.git_command(['submodule', 'update', '-q'] + self.__reference(url) +
+                                 ['--', module], stderr=STDOUT)
+                return
+            self.__clone_submodule(module, module, url,
+                                   self.clone_options(module) + ['--no-checkout'])
+            commit = self.submodule_index()[module]
+            try:
+                self.git_command(['checkout', '-q', commit], module, stderr=STDOUT)
+            except CalledProcessError:
+                # The commit is not on the branches which were cloned
+                self.git_command(['fetch', '-q'] + self.__fetch_depth(module, True) +
+                                 ['origin', commit], module, stderr=STDOUT)
+                self.git_command(['checkout', '-q', commit], module, stderr=STDOUT)
+
+        errors = {}
+        for (module, result, error) in parallel_map(clone, modules, jobs):
+            if error == None:
+                print('  ' + module)
+            else:
+                print('  ' + module + ' (failed)')
+                errors[module] = error_output(error)
+
+        self.__print_errors('clone', modules, errors)
+        return errors
+
     def add_submodule(self, path, url, upstreamurl, type, revision):
         """Add a submodule."""
-        check_output(['git', 'submodule', 'add', url, path])
-        self.set_upstream_url(path, upstreamurl)
-        self.set_upstream_type(path, type)
-        self.set_revision(path, revision)
+        self.__check_output(['git', 'submodule', 'add'] + self.__reference(url) +
+                            [url, path], path)
+        self.set_upstream_url(path, upstreamurl, flush=False)
+        self.set_upstream_type(path, type, flush=False)
+        self.set_revision(path, revision, flush=False)
+        self.flush_gitmodules()
         self.git_command(['add', self.__dot_gitmodules])
 
     def list_submodules(self, gitmodules_file=None):
         """List all submodules."""
         if gitmodules_file == None:
-            gitmodules_file = self.__dot_gitmodules
-        f = open(gitmodules_file)
-        pattern = re.compile('\[submodule "(.*)"]')
-        modules = []
-        for line in f:
-            module = pattern.match(line)
-            if module != None:
-                modules.append(module.group(1))
-        f.close()
-        return modules
+            return self.__gitmodules.subsections('submodule')
+        return GitConfigFile(gitmodules_file).subsections('submodule')
+
+    def submodule_list_file(self):
+        """Get the name of the file written by write_submodule_list."""
+        return os.path.join(self.__git_dir, 'git-module-list')
+
+    def write_submodule_list(self):
+        """
+        Save the list of submodules in .git/git-module-list, so that git-module
+        can list them without parsing .gitmodules or even importing this
+        package. The first line of the file identifies the version of
+        .gitmodules it was made from (its modification time in microseconds,
+        size and inode) and each following line is a submodule. The file is
+        only rewritten if .gitmodules has changed since it was last written.
+        """
+        st = os.stat(self.__dot_gitmodules)
+        header = '%d %d %d' % (int(st.st_mtime * 1000000), st.st_size, st.st_ino)
+        filename = self.submodule_list_file()
+        try:
+            f = open(filename, 'r')
+            current = f.readline().rstrip('\n')
+            f.close()
+        except IOError:
+            current = None
+        if current == header:
+            return
+
+        text = '\n'.join([header] + self.list_submodules()) + '\n'
+        (fd, tmp) = tempfile.mkstemp(dir=self.__git_dir, prefix='git-module-list.')
+        try:
+            os.write(fd, text.encode('utf_8'))
+            os.close(fd)
+            os.rename(tmp, filename)
+        except:
+            os.unlink(tmp)
+            raise
 
     def list_branches(self, module=None):
         """
         List all local branches. If module is not 'None', list all branches
         in that submodule.
         """
+        refs = self.__readable_refs(module)
+        if refs != None:
+            return sorted([name[len('refs/heads/'):] for name in refs.list('refs/heads/')])
+
         res = self.git_command(['branch', '--no-color'], module).splitlines()
         branches = []
         for branch in res:
@@ -243,36 +1760,189 @@ class GitSuperRepository():
         """
         self.git_command(['add', path])
 
-    def remote_status(self, module, branch):
+    def __divergence(self, module, local, upstream, limit=None, counts=None):
+        """
+        List the commits which are only in upstream and only in local, newest
+        first, as Commit objects, reading the output of a single git rev-list
+        --left-right command as it is produced. At most 'limit' commits are
+        kept on each side, or all of them if limit is None, but all of them
+        are counted. If the numbers on each side are already known they can be
+        given as counts, a pair (only upstream, only local), so that git can
+        be stopped as soon as enough commits have been read.
+        """
+        status = {'only-upstream' : [], 'only-downstream' : []}
+        seen   = {'only-upstream' : 0, 'only-downstream' : 0}
+
+        def enough(key, count):
+            return limit != None and len(status[key]) >= min(limit, count)
+
+        for line in self.git_stream(['rev-list', '--left-right', '--oneline',
+                                     local + '...' + upstream], module, separator=b'\n'):
+            key = 'only-upstream' if line[0] == '>' else 'only-downstream'
+            seen[key] += 1
+            if limit == None or len(status[key]) < limit:
+                fields = line[1:].split(' ', 1)
+                status[key].append(Commit(fields[0], fields[1] if len(fields) > 1 else ''))
+            if counts != None and enough('only-upstream', counts[0]) and \
+               enough('only-downstream', counts[1]):
+                break
+
+        if counts == None:
+            counts = (seen['only-upstream'], seen['only-downstream'])
+        status['only-upstream-count']   = counts[0]
+        status['only-downstream-count'] = counts[1]
+        return status
+
+    def count_divergence(self, module, local, upstream):
+        """
+        Count the commits which are only in upstream and only in local with a
+        single git rev-list --count --left-right command, returning the pair
+        (only upstream, only local).
+        """
+        counts = self.git_command(['rev-list', '--count', '--left-right',
+                                   local + '...' + upstream], module).split()
+        return (int(counts[1]), int(counts[0]))
+
+    def remote_status(self, module, branch, limit=None, counts_only=False):
         """
         For the specified branch, lists the commits which are different between
         the local and the tracked upstream version of that branch.
+
+        Returns a dictionary in which 'only-upstream' and 'only-downstream' are
+        lists of the commits, newest first, as Commit objects, and
+        'only-upstream-count' and 'only-downstream-count' are the numbers of
+        them. The lists hold at most 'limit' commits each if limit is not None,
+        and are left empty if counts_only is True, in which case the commits are
+        only counted. Returns None if the branch does not track an upstream
+        branch.
         """
-        try:
-            remote = self.config(['branch.'+branch+'.remote'], module)
-        except:
+        config = self.__module_config(module)
+        remote = config.get('branch', branch, 'remote')
+        remote_ref = config.get('branch', branch, 'merge')
+        if remote == None or remote_ref == None:
             # If the branch doesn't have a remote then return an empty list
             return None
 
-        remote_ref = self.config(['branch.'+branch+'.merge'], module)
-        remote_branch = re.sub('^refs/heads/', '', remote_ref)
+        upstream = remote + '/' + re.sub('^refs/heads/', '', remote_ref)
+        if counts_only:
+            counts = self.count_divergence(module, branch, upstream)
+            return {'only-upstream' : [], 'only-downstream' : [],
+                    'only-upstream-count' : counts[0], 'only-downstream-count' : counts[1]}
+        return self.__divergence(module, branch, upstream, limit)
 
-        only_upstream = self.git_command(['rev-list', '--oneline',
-            branch + '..' + remote + '/' + remote_branch], module).splitlines()
-        only_upstream2 = []
-        for commit in only_upstream:
-            (sha1, title) = commit.split(' ', 1)
-            only_upstream2.append({'SHA1' : sha1, 'title' : title})
+    def branch_status(self, module=None, limit=None, counts_only=False):
+        """
+        Get a list of (branch, status) pairs for every local branch which
+        tracks an upstream branch, with status as returned by remote_status
+        plus the key 'upstream'. Results are kept in the divergence_cache.
+        """
+        refs = self.__readable_refs(module)
+        if refs == None:
+            return self.__branch_status_from_git(module, limit, counts_only)
 
-        only_downstream = self.git_command(['rev-list', '--oneline',
-            remote + '/' + remote_branch + '..' + branch], module).splitlines()
-        only_downstream2 = []
-        for commit in only_downstream:
-            (sha1, title) = commit.split(' ', 1)
-            only_downstream2.append({'SHA1' : sha1, 'title' : title})
+        tracked = self.__tracked_branches(refs, module)
+        if tracked == None:
+            return self.__branch_status_from_git(module, limit, counts_only)
 
-        return {'only-upstream' : only_upstream2,
-                'only-downstream' : only_downstream2}
+        cache = self.divergence_cache(module)
+        statuses = []
+        try:
+            for (branch, upstream) in tracked:
+                local_sha1    = refs.resolve(branch)
+                upstream_sha1 = refs.resolve(upstream)
+                if upstream_sha1 == None:
+                    continue
+                if local_sha1 == upstream_sha1:
+                    status = {'only-upstream' : [], 'only-downstream' : [],
+                              'only-upstream-count' : 0, 'only-downstream-count' : 0}
+                else:
+                    key = (local_sha1, upstream_sha1, 'count' if counts_only else str(limit))
+                    cached = cache.get(key)
+                    if cached != None:
+                        status = dict(cached)
+                        for side in ('only-upstream', 'only-downstream'):
+                            status[side] = [Commit(sha1, title) for (sha1, title) in cached[side]]
+                    else:
+                        if counts_only:
+                            counts = self.count_divergence(module, branch, upstream)
+                            status = {'only-upstream' : [], 'only-downstream' : [],
+                                      'only-upstream-count' : counts[0],
+                                      'only-downstream-count' : counts[1]}
+                        else:
+                            status = self.__divergence(module, branch, upstream, limit)
+                        value = dict(status)
+                        for side in ('only-upstream', 'only-downstream'):
+                            value[side] = [[c.SHA1, c.title] for c in status[side]]
+                        cache.put(key, value)
+                status['upstream'] = upstream
+                statuses.append((branch[len('refs/heads/'):], status))
+        finally:
+            # Write whatever was worked out, once for all of the branches
+            cache.flush()
+        return statuses
+
+    def __branch_status_from_git(self, module, limit, counts_only):
+        """
+        Get the status of every branch as for branch_status, for repositories
+        whose refs cannot be read from disk.
+
+        The branches, their upstreams and how far they are ahead and behind are
+        all read with a single git for-each-ref command, so that nothing else
+        is needed if counts_only is True. Otherwise commit titles are only
+        loaded for branches which have diverged from their upstream, using one
+        git rev-list command for both directions, which is stopped once
+        'limit' commits have been read for each.
+        """
+        ahead  = re.compile('ahead ([0-9]+)')
+        behind = re.compile('behind ([0-9]+)')
+        refs = self.git_command(['for-each-ref',
+            '--format=%(refname)%00%(upstream)%00%(upstream:track)',
+            'refs/heads'], module)
+        statuses = []
+        for ref in refs.splitlines():
+            (branch, upstream, tracking) = ref.split('\0')
+            if upstream == '' or tracking == '[gone]':
+                continue
+            counts = [0, 0]
+            for (i, pattern) in ((0, behind), (1, ahead)):
+                match = pattern.search(tracking)
+                if match:
+                    counts[i] = int(match.group(1))
+            if counts_only or counts == [0, 0]:
+                status = {'only-upstream' : [], 'only-downstream' : [],
+                          'only-upstream-count' : counts[0],
+                          'only-downstream-count' : counts[1]}
+            else:
+                status = self.__divergence(module, branch, upstream, limit, counts)
+            status['upstream'] = upstream
+            statuses.append((re.sub('^refs/heads/', '', branch), status))
+        return statuses
+
+    def iter_summary(self, modules, fetch=False, jobs=1, limit=None, counts_only=False):
+        """
+        Summarize a list of submodules, up to 'jobs' at once, yielding a 'fetch'
+        record for each first if fetch is True, then a 'branch' record with the
+        branch_status of each tracking branch, in the order of modules. A
+        submodule whose branches cannot be read gets a 'failed' record instead.
+        """
+        if fetch:
+            for record in self.iter_fetch(modules, jobs):
+                yield record
+
+        def branch_status(module):
+            return self.branch_status(module, limit, counts_only)
+
+        for (module, (statuses, error, seconds), e) in parallel_map(
+                self.__timed(branch_status), modules, jobs):
+            if error != None:
+                yield {'type' : 'branch', 'module' : module, 'status' : 'failed',
+                       'error' : error_output(error), 'seconds' : round(seconds, 3)}
+                continue
+            for (branch, status) in statuses:
+                record = {'type' : 'branch', 'module' : module, 'branch' : branch,
+                          'seconds' : round(seconds, 3)}
+                record.update(status)
+                yield record
 
     def checkout_modules(self, modules):
         """Checkout a list of submodules to the branches they should be tracking."""
@@ -290,57 +1960,402 @@ class GitSuperRepository():
             print('  ' + module + ': ' + rev)
             self.git_command(['pull', '--ff-only', '-q'], module, exceptions=False)
 
-    def fetch_modules(self, modules):
-        """Fetch a list of submodules from their remotes."""
+    def __print_errors(self, action, modules, errors):
+        """Print the errors from an operation on a list of submodules."""
+        if errors:
+            print('Failed to ' + action + ' ' + str(len(errors)) + ' submodule(s):')
+            for module in modules:
+                if module in errors:
+                    print('  ' + module + ':')
+                    for line in errors[module].splitlines():
+                        print(('    ' + line).rstrip())
+
+    def set_fetch_options(self, depth=None, filter=None, single_branch=None):
+        """
+        Override the fetch options set for every submodule in .gitmodules. An
+        option which is None is left as set in .gitmodules, while a depth of 0,
+        an empty filter or a single_branch of False turn that option off.
+        """
+        self.__fetch_overrides = {'fetchdepth' : depth, 'fetchfilter' : filter,
+                                  'fetchsinglebranch' : single_branch}
+
+    def __fetch_option(self, module, option):
+        """Get a fetch option for a submodule, allowing for any override."""
+        value = self.__fetch_overrides.get(option)
+        if value == None:
+            value = self.__gitmodules.get('submodule', module, option)
+        return value
+
+    def __fetch_depth(self, module, option):
+        """Get the --depth option for a fetch or clone, if any."""
+        depth = self.__fetch_overrides.get('fetchdepth')
+        if depth == None and option:
+            depth = self.__gitmodules.get('submodule', module, 'fetchdepth')
+        if depth != None and int(depth) > 0:
+            return ['--depth=' + str(int(depth))]
+        return []
+
+    def __single_branch(self, module):
+        """
+        Get the revision to fetch if fetchsinglebranch is set for a submodule,
+        or None if every branch should be fetched.
+        """
+        single_branch = self.__fetch_option(module, 'fetchsinglebranch')
+        if single_branch != None and not isinstance(single_branch, bool):
+            single_branch = single_branch.lower() in ('true', 'yes', 'on', '1')
+        if not single_branch:
+            return None
+        try:
+            return self.revision(module)
+        except CalledProcessError:
+            raise ValueError('Error: submodule.' + module + '.fetchsinglebranch '
+                             'is set but there is no revision to fetch.')
+
+    def clone_options(self, module):
+        """Get the git clone options which follow the fetch options of a submodule."""
+        options = self.__fetch_depth(module, True)
+        filter = self.__fetch_option(module, 'fetchfilter')
+        if filter:
+            options.append('--filter=' + filter)
+        revision = self.__single_branch(module)
+        if revision != None:
+            options += ['--single-branch', '--branch', revision]
+        return options
+
+    def fetch_command(self, module):
+        """
+        Get the git fetch command for a submodule, following its fetchfilter
+        and fetchsinglebranch options in .gitmodules.
+        """
+        command = ['fetch', '-q'] + self.__fetch_depth(module, False)
+        filter = self.__fetch_option(module, 'fetchfilter')
+        if filter:
+            command.append('--filter=' + filter)
+
+        revision = self.__single_branch(module)
+        if revision != None:
+            remote = self.__module_config(module).get('branch', revision, 'remote') or 'origin'
+            refs = self.refs(module)
+            if re.match('^[0-9a-f]{40}([0-9a-f]{24})?$', revision):
+                # A commit has no ref to fetch on its own
+                pass
+            elif refs.resolve('refs/tags/' + revision) != None and \
+                 refs.resolve('refs/remotes/' + remote + '/' + revision) == None:
+                command += [remote, '+refs/tags/' + revision + ':refs/tags/' + revision]
+            else:
+                command += [remote, '+refs/heads/' + revision + ':refs/remotes/' + remote +
+                            '/' + revision]
+        return command
+
+    def fetch_module(self, module):
+        """Fetch a submodule from its remote with fetch_command."""
+        self.git_command(self.fetch_command(module), module, stderr=STDOUT)
+
+    def __timed(self, function):
+        """
+        Wrap function so that instead of raising an exception it returns a
+        (result, exception, seconds) tuple.
+        """
+        def timed(item):
+            start = time.time()
+            try:
+                return (function(item), None, time.time() - start)
+            except Exception as e:
+                return (None, e, time.time() - start)
+        return timed
+
+    def iter_fetch(self, modules, jobs=1):
+        """
+        Fetch a list of submodules, up to 'jobs' at once, yielding a 'fetch'
+        record for each in turn.
+        """
+        for (module, (result, error, seconds), e) in parallel_map(
+                self.__timed(self.fetch_module), modules, jobs):
+            yield {'type' : 'fetch', 'module' : module,
+                   'status' : 'ok' if error == None else 'failed',
+                   'error' : None if error == None else error_output(error),
+                   'seconds' : round(seconds, 3)}
+
+    def fetch_modules(self, modules, jobs=1):
+        """
+        Fetch a list of submodules, up to 'jobs' at once. Returns the error
+        output for each submodule which could not be fetched.
+        """
         print('Getting updates for submodules:')
-        for module in modules:
-            print('  ' + module)
-            self.git_command(['fetch', '-q'], module, exceptions=False)
-
-    def sync_gitmodules(self):
-        """Syncronize the super-repository with the information specified in .gitmodules."""
-        # Copy new .gitmodules to a temporary file
-        tmpfile = tempfile.NamedTemporaryFile(delete=False, suffix='.gitmodules', dir=self.__path)
-        new_gitmodules = os.path.join(self.__path, tmpfile.name)
-        tmpfile.close()
-        os.rename(self.__dot_gitmodules, new_gitmodules)
-        self.git_command(['checkout', '--', '.gitmodules'])
+        errors = {}
+        for record in self.iter_fetch(modules, jobs):
+            if record['error'] == None:
+                print('  ' + record['module'])
+            else:
+                print('  ' + record['module'] + ' (failed)')
+                errors[record['module']] = record['error']
+
+        self.__print_errors('fetch', modules, errors)
+        return errors
+
+    def update_module(self, module):
+        """
+        Fetch a submodule, checkout its revision and fast-forward it where
+        possible. Returns 'updated', 'unchanged', 'skipped' if it has no
+        revision or 'diverged' if its branch cannot be fast-forwarded.
+        """
+        before = self.head(module)
+        self.fetch_module(module)
+        try:
+            rev = self.revision(module)
+        except CalledProcessError:
+            return 'skipped'
+        self.git_command(['checkout', '-q', rev], module, stderr=STDOUT)
+        # A tag or commit is checked out detached, and there is nothing to
+        # fast-forward then or if the branch has no upstream
+        refs = self.__readable_refs(module)
+        if refs != None:
+            branch = refs.symbolic_ref('HEAD')
+        else:
+            try:
+                branch = self.git_command(['symbolic-ref', '-q', 'HEAD'], module)
+            except CalledProcessError:
+                branch = None
+        if branch != None and branch.startswith('refs/heads/') and \
+           self.__module_config(module).get('branch', branch[len('refs/heads/'):], 'merge') != None:
+            try:
+                self.git_command(['merge-base', '--is-ancestor', 'HEAD', '@{upstream}'], module,
+                                 stderr=STDOUT)
+            except CalledProcessError as e:
+                # merge-base exits with status 1 only if HEAD is not an ancestor
+                if e.returncode != 1:
+                    raise
+                return 'diverged'
+            self.git_command(['merge', '--ff-only', '-q', '@{upstream}'], module, stderr=STDOUT)
+        if self.head(module) != before:
+            return 'updated'
+        return 'unchanged'
 
+    def iter_update(self, modules, jobs=1):
+        """
+        Update a list of submodules, up to 'jobs' at once, yielding an 'update'
+        record for each in turn.
+        """
+        for (module, (status, error, seconds), e) in parallel_map(
+                self.__timed(self.update_module), modules, jobs):
+            yield {'type' : 'update', 'module' : module,
+                   'status' : status if error == None else 'failed',
+                   'error' : None if error == None else error_output(error),
+                   'seconds' : round(seconds, 3)}
+
+    def update_modules(self, modules, jobs=1):
+        """
+        Update a list of submodules, up to 'jobs' at once. Returns the status
+        of each submodule.
+        """
+        print('Updating submodules:')
+        statuses = {}
+        errors = {}
+        for record in self.iter_update(modules, jobs):
+            module = record['module']
+            if record['error'] != None:
+                errors[module] = record['error']
+            statuses[module] = record['status']
+            print('  ' + module + ': ' + record['status'])
+
+        counts = []
+        for status in ('updated', 'unchanged', 'skipped', 'diverged', 'failed'):
+            counts.append(str(list(statuses.values()).count(status)) + ' ' + status)
+        print(', '.join(counts))
+
+        self.__print_errors('update', modules, errors)
+        return statuses
+
+    def resolve_url(self, url):
+        """
+        Resolve a submodule URL starting with ./ or ../ against the URL of the
+        default remote of the super-repository, or its own path if it has no
+        default remote, in the same way as git submodule.
+        """
+        if not (url.startswith('./') or url.startswith('../')):
+            return url
+        config = self.__module_config(None)
+        remote = None
+        branch = self.refs().symbolic_ref('HEAD')
+        if branch != None and branch.startswith('refs/heads/'):
+            remote = config.get('branch', branch[len('refs/heads/'):], 'remote')
+        base = config.get('remote', remote or 'origin', 'url')
+        if base == None:
+            base = self.__path
+        base = base.rstrip('/')
+
+        while True:
+            if url.startswith('./'):
+                url = url[2:]
+            elif url.startswith('../'):
+                url = url[3:]
+                i = max(base.rfind('/'), base.rfind(':'))
+                if i == -1:
+                    raise ValueError('Error: cannot resolve ' + url + ' relative to ' + base + '.')
+                # Keep the colon of an scp-style host:path URL
+                base = base[:i + 1] if base[i] == ':' else base[:i]
+            else:
+                break
+        if base.endswith(':'):
+            return base + url
+        return base + '/' + url
+
+    def __clone_submodule(self, name, path, url, options=[]):
+        """
+        Clone a submodule into path with its git directory in .git/modules/name,
+        returning the commit checked out.
+        """
+        module_abspath = os.path.join(self.__path, path)
+        git_dir = os.path.join(self.__git_dir, 'modules', name)
+        if os.path.exists(git_dir):
+            raise ValueError('Error: ' + git_dir + ' already exists.')
+        try:
+            os.makedirs(os.path.dirname(git_dir))
+        except OSError:
+            # Another clone may have just created it
+            if not os.path.isdir(os.path.dirname(git_dir)):
+                raise
+        self.__check_output(['git', 'clone', '-q', '--separate-git-dir=' + git_dir] +
+                            self.__reference(url) + options + [url, module_abspath],
+                            path, cwd=self.__path, stderr=STDOUT)
+
+        # Link the work tree and git directory with relative paths, as git
+        # submodule does, so that the super-repository can be moved
+        f = open(os.path.join(module_abspath, '.git'), 'w')
+        f.write('gitdir: ' + os.path.relpath(git_dir, module_abspath) + '\n')
+        f.close()
+        config = GitConfigFile(os.path.join(git_dir, 'config'))
+        config.set('core', None, 'worktree', os.path.relpath(module_abspath, git_dir))
+        config.flush()
+
+        return self.__check_output(['git', '--git-dir=' + git_dir,
+            'rev-parse', 'HEAD'], path, cwd=module_abspath).decode('utf_8').rstrip('\n')
+
+    def sync_gitmodules(self, jobs=1):
+        """
+        Add and remove submodules to match .gitmodules, cloning up to 'jobs' at
+        once. Returns the error output for each submodule which could not be
+        cloned, in which case, as on any other error, nothing is changed.
+        """
         # Find out which submodules are new or old (removed)
-        previous_submodules = set(self.list_submodules())
-        current_submodules = set(self.list_submodules(gitmodules_file = new_gitmodules))
+        staged = self.cat_object(':.gitmodules')
+        (f, staged_gitmodules) = tempfile.mkstemp(suffix='.gitmodules')
+        try:
+            if staged != None:
+                os.write(f, staged[2])
+            os.close(f)
+            previous_config = GitConfigFile(staged_gitmodules)
+            previous_submodules = set(previous_config.subsections('submodule'))
+        finally:
+            os.remove(staged_gitmodules)
+        current_submodules = set(self.list_submodules())
 
         common_submodules = current_submodules & previous_submodules
-        new_submodules = current_submodules - common_submodules
-        old_submodules = previous_submodules - common_submodules
+        new_submodules = sorted(current_submodules - common_submodules)
+        old_submodules = sorted(previous_submodules - common_submodules)
+
+        def path(config, module):
+            return config.get('submodule', module, 'path') or module
+
+        # Clone the new submodules
+        urls = {}
+        def clone(module):
+            module_path = path(self.__gitmodules, module)
+            urls[module] = self.resolve_url(self.__gitmodules.get('submodule', module, 'url'))
+            if os.path.exists(os.path.join(self.__path, module_path)):
+                raise ValueError('Error: ' + module_path + ' already exists.')
+            return self.__clone_submodule(module, module_path, urls[module],
+                self.clone_options(module))
+
+        commits = {}
+        errors = {}
+        for (module, commit, error) in parallel_map(clone, new_submodules, jobs):
+            print('Adding submodule ' + module)
+            if error == None:
+                commits[module] = commit
+            else:
+                errors[module] = error_output(error)
+
+        def remove_clones():
+            for module in commits:
+                shutil.rmtree(os.path.join(self.__path, path(self.__gitmodules, module)))
+                shutil.rmtree(os.path.join(self.__git_dir, 'modules', module))
+
+        if errors:
+            remove_clones()
+            self.__print_errors('clone', new_submodules, errors)
+            return errors
 
         for module in old_submodules:
-            self.rm_submodule(module)
+            print('Removing submodule ' + module)
 
+        # Update .git/config and the index
+        config = GitConfigFile(os.path.join(self.__git_dir, 'config'))
+        original_config = config.text()
+        for module in old_submodules:
+            config.remove_section('submodule', module)
         for module in new_submodules:
-            path = self.config(['submodule.' + module + '.path'], file=new_gitmodules)
-            url =  self.config(['submodule.' + module + '.url'], file=new_gitmodules)
-            upstreamurl = self.config(['submodule.' + module + '.upstreamurl'], file=new_gitmodules)
-            type =  self.config(['submodule.' + module + '.upstreamtype'], file=new_gitmodules)
-            revision =  self.config(['submodule.' + module + '.revision'], file=new_gitmodules)
-            self.add_submodule(path, url, upstreamurl, type, revision)
-
-        os.rename(new_gitmodules, self.__dot_gitmodules)
-        self.git_command(['add', self.__dot_gitmodules])
+            config.set('submodule', module, 'url', urls[module])
+
+        index_info = ''
+        for module in old_submodules:
+            index_info += '0 ' + '0' * 40 + '\t' + path(previous_config, module) + '\n'
+        for module in new_submodules:
+            index_info += '160000 ' + commits[module] + '\t' + path(self.__gitmodules, module) + '\n'
+
+        try:
+            config.flush()
+            gitmodules_blob = self.git_command(['hash-object', '-w', '--', '.gitmodules'])
+            index_info += '100644 ' + gitmodules_blob + '\t.gitmodules\n'
+            self.git_input(['update-index', '--index-info'], index_info)
+        except:
+            remove_clones()
+            f = open(config.filename(), 'wb')
+            f.write(original_config.encode('utf_8'))
+            f.close()
+            raise
+        return {}
 
     def stage_submodule(self, module, version):
         # See http://serverfault.com/questions/251792/update-git-super-repository-automatically-when-a-submodule-gets-updated
         self.git_command(['update-index', '--cacheinfo', '160000', version, module])
 
     def current_submodule_commit(self, module):
-        return self.git_command(['ls-tree', 'HEAD', module]).split()[2]
+        module = os.path.normpath(module)
+        commits = self.submodule_head()
+        if module in commits:
+            return commits[module]
+        # The submodule may have been removed from the index
+        entry = self.tree_entry('HEAD', module)
+        if entry == None or entry[0] != '160000':
+            raise ValueError('Error: ' + module + ' is not a submodule in HEAD.')
+        return entry[1]
 
     def submodule_commits_since(self, module, since):
         return self.git_command(['rev-list', "--reverse", since+'..HEAD'],module=module).split()
 
+    def submodule_log_since(self, module, since):
+        """
+        Iterate over the commits made in a submodule since 'since', oldest
+        first, using a single git log process. Each commit is a dictionary with
+        the keys 'SHA1', 'author', 'date' (in git's raw date format) and
+        'message'.
+        """
+        keys   = ['SHA1', 'author', 'date', 'message']
+        format = '%x00'.join(['%H', '%an <%ae>', '%ad', '%s%n%b'])
+        fields = []
+        for field in self.git_stream(['log', '-z', '--reverse', '--date=raw',
+                '--format=' + format, since + '..HEAD'], module):
+            fields.append(field)
+            if len(fields) == len(keys):
+                commit = dict(zip(keys, fields))
+                commit['message'] = commit['message'].rstrip('\n')
+                yield commit
+                fields = []
+
     def commit(self, message, author=None, date=None):
         (f, name) = tempfile.mkstemp()
-        os.write(f,message)
+        os.write(f,message.encode('utf_8'))
         os.close(f)
         args = ['commit', '-F', name]
         if author != None:
@@ -349,3 +2364,70 @@ class GitSuperRepository():
             args += ['--date', date]
         self.git_command(args)
         os.remove(name)
+
+    def commit_submodule_updates(self, commits):
+        """
+        Commit each (module, commit) pair in 'commits', with commit as yielded
+        by submodule_log_since, using one git fast-import stream. HEAD and the
+        index are left as they were if anything fails. Returns the new HEAD.
+        """
+        ref = 'refs/git-module/commit-incremental'
+        head = self.rev_parse('HEAD^{commit}')
+        committer = self.git_command(['var', 'GIT_COMMITTER_IDENT'])
+        self.git_command(['update-ref', '-d', ref])
+
+        (args, cwd) = self.git_invocation(['fast-import', '--quiet', '--done'])
+        start = time.time()
+        process = Popen(args, cwd=cwd, stdin=PIPE)
+        updated = {}
+        try:
+            for (module, commit) in commits:
+                message = commit['message'].encode('utf_8')
+                stream  = 'commit ' + ref + '\n'
+                stream += 'author ' + commit['author'] + ' ' + commit['date'] + '\n'
+                stream += 'committer ' + committer + '\n'
+                stream += 'data ' + str(len(message)) + '\n'
+                process.stdin.write(stream.encode('utf_8') + message + b'\n')
+                stream = ''
+                if not updated and head != None:
+                    stream += 'from ' + head + '\n'
+                stream += 'M 160000 ' + commit['SHA1'] + ' ' + module + '\n\n'
+                process.stdin.write(stream.encode('utf_8'))
+                updated[module] = commit['SHA1']
+            process.stdin.write(b'done\n')
+            process.stdin.close()
+            process.wait()
+            self.__trace(args, None, start, process.returncode, 0)
+            if process.returncode != 0:
+                raise CalledProcessError(process.returncode, args)
+        except:
+            if process.poll() == None:
+                process.kill()
+                process.wait()
+                self.__trace(args, None, start, process.returncode, 0)
+            self.git_command(['update-ref', '-d', ref])
+            raise
+
+        if not updated:
+            return head
+
+        refs = self.__readable_refs(None)
+        new_head = refs.resolve(ref) if refs != None else None
+        if new_head == None:
+            new_head = self.rev_parse(ref)
+        try:
+            update_head = ['update-ref', '-m', 'git-module: commit submodule updates', 'HEAD', new_head]
+            if head != None:
+                update_head.append(head)
+            self.git_command(update_head)
+            try:
+                index_info = ''.join(['160000 ' + sha1 + '\t' + module + '\n'
+                                      for (module, sha1) in updated.items()])
+                self.git_input(['update-index', '--index-info'], index_info)
+            except:
+                if head != None:
+                    self.git_command(['update-ref', 'HEAD', head, new_head])
+                raise
+        finally:
+            self.git_command(['update-ref', '-d', ref])
+        return new_head
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# bench_update_merge.py
+#
+# Benchmark for the update.merge server hook.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Build a large synthetic history and time the update.merge hook on pushes
+containing many merges, comparing it with the original implementation which
+ran merge-base and four rev-list commands for every merge.
+
+The repository has a long master branch and many other branches. Two pushes to
+master are checked: one in which every merge brings in an existing branch and
+so should be allowed, and one ending in a merge of new commits made without
+rebasing, which should be denied. Both implementations must agree on each.
+
+Example:
+    python bench/bench_update_merge.py --history 20000 --branches 500 --merges 50
+"""
+
+from __future__ import print_function
+
+import sys, os
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+hook = os.path.join(os.path.dirname(bench_dir), 'update.merge')
+
+def git(args, cwd, input=None):
+    process = subprocess.Popen(['git'] + args, cwd=cwd,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = process.communicate(input)[0]
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return output.decode('utf_8').rstrip('\n')
+
+class History():
+    """Builds a git fast-import stream, one commit at a time."""
+    def __init__(self):
+        self.stream = []
+        self.marks = 0
+        self.time = 1300000000
+
+    def commit(self, ref, parents, message):
+        self.marks += 1
+        self.time += 60
+        self.stream.append('commit ' + ref + '\nmark :' + str(self.marks) +
+            '\ncommitter Bench <bench@example.com> ' + str(self.time) + ' +0000\n' +
+            'data ' + str(len(message)) + '\n' + message + '\n')
+        if parents:
+            self.stream.append('from ' + parents[0] + '\n')
+        for parent in parents[1:]:
+            self.stream.append('merge ' + parent + '\n')
+        self.stream.append('\n')
+        return ':' + str(self.marks)
+
+    def text(self):
+        return ''.join(self.stream)
+
+def make_repository(root, history, branches, merges):
+    """
+    Create a bare repository with a master branch of 'history' commits and
+    'branches' other branches, and the commits of two pushes to master.
+    Returns (oldrev, allowed newrev, denied newrev).
+    """
+    repo = os.path.join(root, 'repo.git')
+    git(['init', '-q', '--bare', repo], root)
+    h = History()
+
+    master = []
+    for i in range(history):
+        master.append(h.commit('refs/heads/master', master[-1:], 'master ' + str(i)))
+
+    # Existing branches, each with a few commits forked from an older commit
+    features = []
+    for b in range(branches):
+        fork = master[(b * 7919) % (history - 1)]
+        tip = fork
+        for i in range(3):
+            tip = h.commit('refs/heads/branch%04d' % b, [tip], 'branch %d commit %d' % (b, i))
+        features.append(tip)
+
+    # A push which merges an existing branch after each couple of new commits
+    tip = master[-1]
+    for m in range(merges):
+        for i in range(2):
+            tip = h.commit('refs/pushes/allowed', [tip], 'new %d %d' % (m, i))
+        tip = h.commit('refs/pushes/allowed', [tip, features[m % branches]], 'merge %d' % m)
+
+    # A push made by pulling without rebasing new local commits
+    tip = master[-10]
+    for i in range(3):
+        tip = h.commit('refs/pushes/denied', [tip], 'local ' + str(i))
+    h.commit('refs/pushes/denied', [tip, master[-1]], 'merge without rebase')
+
+    git(['fast-import', '--quiet'], repo, h.text().encode('utf_8'))
+    return (repo, git(['rev-parse', 'master'], repo),
+            git(['rev-parse', 'refs/pushes/allowed'], repo),
+            git(['rev-parse', 'refs/pushes/denied'], repo))
+
+def original_hook(repo, oldrev, newrev):
+    """The original implementation of update.merge, for comparison."""
+    merges = git(['log', '--format=%H %P', '--merges', oldrev + '..' + newrev], repo).split('\n')
+    for merge in merges:
+        if merge == '':
+            continue
+        [commit, parent1, parent2] = merge.split(' ')
+        merge_base = git(['merge-base', parent1, parent2], repo)
+        commits1a = git(['rev-list', parent2 + '..' + parent1, '--not', merge_base], repo).split('\n')
+        commits1b = git(['rev-list', parent2 + '..' + parent1, '--not', '--branches', merge_base], repo).split('\n')
+        commits2a = git(['rev-list', parent1 + '..' + parent2, '--not', merge_base], repo).split('\n')
+        commits2b = git(['rev-list', parent1 + '..' + parent2, '--not', '--branches', merge_base], repo).split('\n')
+        if (commits1a == commits1b and commits1a != ['']) or (commits2a == commits2b and commits2a != ['']):
+            return 1
+    return 0
+
+def new_hook(repo, oldrev, newrev):
+    devnull = open(os.devnull, 'w')
+    status = subprocess.call([sys.executable, hook, 'refs/heads/master', oldrev, newrev],
+                             cwd=repo, stdout=devnull)
+    devnull.close()
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description =
+        'Benchmark the update.merge hook on a synthetic history.')
+    parser.add_argument('--history', type=int, default=20000, metavar='N',
+        help='number of commits on master')
+    parser.add_argument('--branches', type=int, default=200, metavar='B',
+        help='number of other branches')
+    parser.add_argument('--merges', type=int, default=30, metavar='M',
+        help='number of merges in the allowed push')
+    parser.add_argument('--skip-original', action='store_true',
+        help='do not time the original implementation')
+    parser.add_argument('--output', '-o', metavar='FILE',
+        help='write the results to FILE instead of stdout')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='update-merge-bench-')
+    try:
+        start = time.time()
+        (repo, oldrev, allowed, denied) = make_repository(root, args.history,
+                                                          args.branches, args.merges)
+        print('Created repository in %.1fs' % (time.time() - start), file=sys.stderr)
+
+        implementations = [('update.merge', new_hook)]
+        if not args.skip_original:
+            implementations.append(('original', original_hook))
+
+        results = []
+        for (push, newrev, expected) in (('allowed', allowed, 0), ('denied', denied, 1)):
+            for (name, function) in implementations:
+                start = time.time()
+                status = function(repo, oldrev, newrev)
+                seconds = time.time() - start
+                print('%-8s %-14s %10.3fs  exit status %d' % (push, name, seconds, status),
+                      file=sys.stderr)
+                if status != expected:
+                    raise RuntimeError(name + ' gave the wrong result for the ' + push + ' push')
+                results.append({'push' : push, 'implementation' : name,
+                                'seconds' : round(seconds, 4), 'status' : status})
+
+        output = {'parameters' : {'history' : args.history, 'branches' : args.branches,
+                                  'merges' : args.merges},
+                  'results' : results}
+        if args.output == None:
+            print(json.dumps(output, indent=2, sort_keys=True))
+        else:
+            f = open(args.output, 'w')
+            json.dump(output, f, indent=2, sort_keys=True)
+            f.close()
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    sys.exit(main())
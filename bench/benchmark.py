@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+#
+# benchmark.py
+#
+# Benchmarks for git-module and the GitSuperRepository package.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Build a synthetic super-repository and time git-module and GitSuperRepository
+operations on it.
+
+The super-repository has a configurable number of submodules, each cloned from
+a local file:// upstream with a number of commits and branches. Every branch
+is checked out locally with a local commit, and the upstreams then gain new
+commits, so that branches have diverged from their upstreams. Each git-module
+subcommand and the main GitSuperRepository methods are then timed, and the
+number of git processes each one starts is counted using a wrapper around git
+placed first in PATH. The results are written as JSON so that they can be
+compared between versions.
+
+Example:
+    python bench/benchmark.py --modules 150 --commits 10 --branches 10 --output results.json
+"""
+
+from __future__ import print_function
+
+import sys, os
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import time
+
+bench_dir  = os.path.dirname(os.path.abspath(__file__))
+source_dir = os.path.dirname(bench_dir)
+git_module = os.path.join(source_dir, 'git-module')
+
+sys.path.insert(0, source_dir)
+from GitSuperRepository import GitSuperRepository
+
+def git(args, cwd, input=None):
+    """Run the real git (bypassing the counting wrapper) and return its output."""
+    process = subprocess.Popen([real_git, '-c', 'protocol.file.allow=always'] + args,
+        cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = process.communicate(input)[0]
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, args)
+    return output.decode('utf_8').rstrip('\n')
+
+def fast_import_commits(ref, parent, count, name, start):
+    """Get a fast-import stream adding 'count' commits to ref on top of parent."""
+    stream = ''
+    for i in range(count):
+        message = name + ' commit ' + str(i)
+        content = name + ' ' + str(i) + '\n'
+        stream += 'commit ' + ref + '\n'
+        stream += 'committer Bench <bench@example.com> ' + str(start + i) + ' +0000\n'
+        stream += 'data ' + str(len(message)) + '\n' + message + '\n'
+        if i == 0 and parent != None:
+            stream += 'from ' + parent + '\n'
+        stream += 'M 644 inline ' + name + '.txt\n'
+        stream += 'data ' + str(len(content)) + '\n' + content + '\n'
+    return stream
+
+def make_super_repository(root, modules, commits, branches):
+    """
+    Create a super-repository in root/super with submodules cloned from bare
+    upstream repositories in root/upstream. Returns the path of the
+    super-repository and the list of submodule paths.
+    """
+    upstream_dir = os.path.join(root, 'upstream')
+    super_dir = os.path.join(root, 'super')
+    os.makedirs(upstream_dir)
+    os.makedirs(super_dir)
+    now = int(time.time()) - 100000
+
+    # Upstream repositories with a master branch and 'branches' other branches
+    for m in range(modules):
+        upstream = os.path.join(upstream_dir, 'module%03d.git' % m)
+        git(['init', '-q', '--bare', upstream], root)
+        stream = fast_import_commits('refs/heads/master', None, commits, 'master', now)
+        for b in range(branches):
+            stream += fast_import_commits('refs/heads/branch%02d' % b,
+                'refs/heads/master', commits, 'branch%02d' % b, now + commits)
+        git(['fast-import', '--quiet'], upstream, stream.encode('utf_8'))
+        git(['symbolic-ref', 'HEAD', 'refs/heads/master'], upstream)
+
+    # The super-repository
+    git(['init', '-q', super_dir], root)
+    paths = []
+    gitmodules = ''
+    for m in range(modules):
+        path = 'modules/module%03d' % m
+        url = 'file://' + os.path.join(upstream_dir, 'module%03d.git' % m)
+        git(['submodule', 'add', '-q', url, path], super_dir)
+        gitmodules += '[submodule "' + path + '"]\n\tpath = ' + path + '\n\turl = ' + url + \
+                      '\n\tupstreamurl = ' + url + '\n\tupstreamtype = git\n\trevision = master\n'
+        paths.append(path)
+    f = open(os.path.join(super_dir, '.gitmodules'), 'w')
+    f.write(gitmodules)
+    f.close()
+    git(['add', '.gitmodules'], super_dir)
+    git(['commit', '-q', '-m', 'Add submodules'], super_dir)
+
+    # Local tracking branches with local commits, and new upstream commits
+    for m in range(modules):
+        module_dir = os.path.join(super_dir, paths[m])
+        upstream = os.path.join(upstream_dir, 'module%03d.git' % m)
+        git(['checkout', '-q', 'master'], module_dir)
+        stream = fast_import_commits('refs/heads/master', 'refs/heads/master^0',
+                                     commits, 'master-new', now + 2 * commits)
+        for b in range(branches):
+            branch = 'branch%02d' % b
+            git(['branch', '-q', '--track', branch, 'origin/' + branch], module_dir)
+            tree = git(['rev-parse', branch + '^{tree}'], module_dir)
+            local = git(['commit-tree', tree, '-p', branch, '-m', 'Local change'], module_dir)
+            git(['update-ref', 'refs/heads/' + branch, local], module_dir)
+            stream += fast_import_commits('refs/heads/' + branch, 'refs/heads/' + branch + '^0',
+                                          1, branch + '-new', now + 3 * commits)
+        git(['fast-import', '--quiet'], upstream, stream.encode('utf_8'))
+
+    return (super_dir, paths)
+
+def make_git_wrapper(root, log):
+    """Create a directory with a git wrapper which logs each invocation to log."""
+    wrapper_dir = os.path.join(root, 'bin')
+    os.makedirs(wrapper_dir)
+    wrapper = os.path.join(wrapper_dir, 'git')
+    f = open(wrapper, 'w')
+    f.write('#!/bin/sh\necho x >> "' + log + '"\nexec "' + real_git + '" "$@"\n')
+    f.close()
+    os.chmod(wrapper, 0o755)
+    return wrapper_dir
+
+def count_lines(filename):
+    if not os.path.exists(filename):
+        return 0
+    f = open(filename)
+    count = len(f.readlines())
+    f.close()
+    return count
+
+def measure(name, kind, function, log, cache_dir=None):
+    """
+    Time function and count the git processes it starts. If cache_dir is
+    given, it is removed first so that the measurement starts from a cold
+    cache.
+    """
+    if os.path.exists(log):
+        os.remove(log)
+    if cache_dir != None and os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    start = time.time()
+    function()
+    seconds = time.time() - start
+    result = {'name' : name, 'kind' : kind, 'seconds' : round(seconds, 4),
+              'git_processes' : count_lines(log)}
+    print('%-40s %10.3fs %8d git processes' % (name, seconds, result['git_processes']),
+          file=sys.stderr)
+    return result
+
+def run_git_module(super_dir, args):
+    """Return a function which runs git-module with args in the super-repository."""
+    def run():
+        devnull = open(os.devnull, 'w')
+        subprocess.check_call([sys.executable, git_module] + args, cwd=super_dir,
+                              stdout=devnull, env=os.environ)
+        devnull.close()
+    return run
+
+def run_method(super_dir, method):
+    """
+    Return a function which calls method with a fresh GitSuperRepository, so
+    that nothing is cached in memory from earlier measurements.
+    """
+    def run():
+        sr = GitSuperRepository(super_dir, persistent=True)
+        try:
+            method(sr)
+        finally:
+            sr.close()
+    return run
+
+def all_branch_statuses(sr, modules):
+    for module in modules:
+        for branch in sr.list_branches(module):
+            sr.remote_status(module, branch)
+
+def benchmark(args):
+    root = args.workdir
+    if root == None:
+        root = tempfile.mkdtemp(prefix='git-module-bench-')
+    log = os.path.join(root, 'git-processes.log')
+
+    start = time.time()
+    (super_dir, modules) = make_super_repository(root, args.modules, args.commits, args.branches)
+    print('Created super-repository in %.1fs' % (time.time() - start), file=sys.stderr)
+
+    os.environ['PATH'] = make_git_wrapper(root, log) + os.pathsep + os.environ['PATH']
+    os.environ['PYTHONPATH'] = source_dir
+    os.environ['GIT_CONFIG_COUNT'] = '1'
+    os.environ['GIT_CONFIG_KEY_0'] = 'protocol.file.allow'
+    os.environ['GIT_CONFIG_VALUE_0'] = 'always'
+
+    jobs = ['--jobs', str(args.jobs)]
+    results = []
+    # The divergence cache on disk is removed before every measurement except
+    # those marked as warm
+    cache_dir = os.path.join(super_dir, '.git', 'git-module', 'divergence')
+
+    # GitSuperRepository methods which only read the repository
+    methods = [
+        ('list_submodules', lambda sr: sr.list_submodules()),
+        ('revision', lambda sr: [sr.revision(m) for m in modules]),
+        ('is_submodule', lambda sr: [sr.is_submodule(m) for m in modules]),
+        ('current_submodule_commit', lambda sr: [sr.current_submodule_commit(m) for m in modules]),
+        ('list_branches', lambda sr: [sr.list_branches(m) for m in modules]),
+        ('remote_status', lambda sr: all_branch_statuses(sr, modules)),
+        ('branch_status', lambda sr: [sr.branch_status(m) for m in modules]),
+    ]
+    for (name, method) in methods:
+        results.append(measure(name, 'method', run_method(super_dir, method), log, cache_dir))
+
+    # git-module subcommands, in an order where each leaves work for the next
+    commands = [
+        ('ls', ['ls'], True),
+        ('summary --no-fetch', ['summary', '--no-fetch'] + jobs, True),
+        ('summary --no-fetch (warm cache)', ['summary', '--no-fetch'] + jobs, False),
+        ('fetch', ['fetch'] + jobs, True),
+        ('summary --no-fetch (after fetch)', ['summary', '--no-fetch'] + jobs, True),
+        ('update', ['update'] + jobs, True),
+    ]
+    for (name, command, cold) in commands:
+        results.append(measure(name, 'command', run_git_module(super_dir, command), log,
+                               cache_dir if cold else None))
+
+    # commit-incremental, with and without fast-import, from the same state
+    head = git(['rev-parse', 'HEAD'], super_dir)
+    results.append(measure('commit-incremental', 'command',
+        run_git_module(super_dir, ['commit-incremental', '--sort']), log, cache_dir))
+    git(['reset', '-q', head], super_dir)
+    results.append(measure('commit-incremental --fast-import', 'command',
+        run_git_module(super_dir, ['commit-incremental', '--sort', '--fast-import']), log, cache_dir))
+
+    # sync after removing one submodule and adding another to .gitmodules
+    gitmodules = os.path.join(super_dir, '.gitmodules')
+    git(['config', '--file', gitmodules, '--remove-section', 'submodule.' + modules[-1]], super_dir)
+    for (key, value) in (('path', 'modules/extra'), ('url', 'file://' + os.path.join(root, 'upstream', 'module000.git')),
+                         ('upstreamurl', 'file://' + os.path.join(root, 'upstream', 'module000.git')),
+                         ('upstreamtype', 'git'), ('revision', 'master')):
+        git(['config', '--file', gitmodules, 'submodule.modules/extra.' + key, value], super_dir)
+    results.append(measure('sync', 'command', run_git_module(super_dir, ['sync']), log, cache_dir))
+
+    output = {
+        'parameters' : {'modules' : args.modules, 'commits' : args.commits,
+                        'branches' : args.branches, 'jobs' : args.jobs},
+        'git_version' : git(['--version'], root),
+        'python_version' : sys.version.split()[0],
+        'results' : results,
+    }
+
+    if args.output == None:
+        print(json.dumps(output, indent=2, sort_keys=True))
+    else:
+        f = open(args.output, 'w')
+        json.dump(output, f, indent=2, sort_keys=True)
+        f.close()
+
+    if not args.keep and args.workdir == None:
+        shutil.rmtree(root)
+    else:
+        print('Kept benchmark repositories in ' + root, file=sys.stderr)
+
+def main():
+    global real_git
+    parser = argparse.ArgumentParser(description =
+        'Benchmark git-module on a synthetic super-repository.')
+    parser.add_argument('--modules', type=int, default=20, metavar='N',
+        help='number of submodules')
+    parser.add_argument('--commits', type=int, default=10, metavar='M',
+        help='number of commits on each branch of each submodule')
+    parser.add_argument('--branches', type=int, default=3, metavar='B',
+        help='number of diverged branches in each submodule')
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+        help='value of --jobs to use for git-module subcommands')
+    parser.add_argument('--output', '-o', metavar='FILE',
+        help='write the results to FILE instead of stdout')
+    parser.add_argument('--workdir', metavar='DIR',
+        help='directory to create the repositories in (kept afterwards)')
+    parser.add_argument('--keep', action='store_true',
+        help='do not delete the temporary repositories afterwards')
+    args = parser.parse_args()
+
+    real_git = subprocess.check_output(['sh', '-c', 'command -v git']).decode('utf_8').strip()
+    benchmark(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+#
+# helpers.py
+#
+# Shared fixtures for the tests of the GitSuperRepository package.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Shared fixtures for the tests. Importing this module makes the package in the
+directory above importable.
+"""
+
+import sys, os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+test_dir   = os.path.dirname(os.path.abspath(__file__))
+source_dir = os.path.dirname(test_dir)
+
+sys.path.insert(0, source_dir)
+
+def git(args, cwd):
+    """Run git and return its output."""
+    output = subprocess.check_output(['git', '-c', 'protocol.file.allow=always'] + args,
+                                     cwd=cwd, stderr=subprocess.STDOUT)
+    return output.decode('utf_8').rstrip('\n')
+
+class TempDirTestCase(unittest.TestCase):
+    """
+    A test run in a new temporary directory, self.root, with a git identity
+    set in the environment. The environment is restored and the directory
+    removed afterwards.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='git-module-test-')
+        self.environ = dict(os.environ)
+        for variable in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+            os.environ[variable] = 'Test'
+        for variable in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+            os.environ[variable] = 'test@example.com'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.root)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#
+# test_GitConfigFile.py
+#
+# Tests for the GitConfigFile class of the GitSuperRepository package.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Check that GitConfigFile reads configuration files in the same way as git
+config, and that the files it writes read back the same way with git config.
+"""
+
+import os
+import subprocess
+import unittest
+
+from helpers import TempDirTestCase
+from GitSuperRepository import GitConfigFile
+
+TRICKY = '''# A comment before any section
+; and another
+[core]
+\tbare = false ; a comment after a value
+\tflag
+\tIgnoreCase = true # a comment after a value
+  indented   =   spaces around   the value
+[submodule "mods/a"]  # a comment after a header
+\tpath = mods/a
+\turl = "file:///a;b#c"
+\tquoted = " leading and trailing "
+\tescapes = tab\\there \\"quoted\\" back\\\\slash new\\nline
+\tcontinued = one \\
+two \\
+three
+\tmixed = "half quoted" and not
+\tempty =
+[submodule "with \\"quotes\\" and spaces"]
+\tpath = odd
+[Deprecated.SubSection]
+\tkey = deprecated syntax
+[submodule "mods/a"]
+\tpath = mods/a-again
+\textra = second section
+[remote "origin"]
+\tfetch = +refs/heads/*:refs/remotes/origin/*
+\tfetch = +refs/pull/*/head:refs/remotes/origin/pr/*
+\tfetch = ^refs/heads/skip
+'''
+
+class GitConfigFileTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.filename = os.path.join(self.root, 'config')
+        f = open(self.filename, 'wb')
+        f.write(TRICKY.encode('utf_8'))
+        f.close()
+
+    def git_config(self, args=['--list']):
+        """Get the (section, subsection, key, value) list from git config."""
+        output = subprocess.check_output(['git', 'config', '--file', self.filename,
+                                          '--null'] + args).decode('utf_8')
+        entries = []
+        for item in output.split('\0')[:-1]:
+            if '\n' in item:
+                (name, value) = item.split('\n', 1)
+            else:
+                (name, value) = (item, 'true')
+            section = name[:name.index('.')]
+            key = name[name.rindex('.') + 1:]
+            subsection = name[len(section) + 1:len(name) - len(key) - 1] or None
+            entries.append((section, subsection, key, value))
+        return entries
+
+    def assert_same_as_git(self, config):
+        entries = self.git_config()
+        names = set((section, subsection, key) for (section, subsection, key, value) in entries)
+        for (section, subsection, key) in names:
+            values = [value for (s, ss, k, value) in entries
+                      if (s, ss, k) == (section, subsection, key)]
+            self.assertEqual(config.get_all(section, subsection, key), values)
+            self.assertEqual(config.get(section, subsection, key), values[-1])
+
+        for section in set(section for (section, subsection, key) in names):
+            subsections = []
+            for (s, subsection, key, value) in entries:
+                if s == section and subsection != None and subsection not in subsections:
+                    subsections.append(subsection)
+            self.assertEqual(config.subsections(section), subsections)
+
+        for (section, subsection) in set((s, ss) for (s, ss, k) in names):
+            options = {}
+            for (s, ss, key, value) in entries:
+                if (s, ss) == (section, subsection):
+                    options[key] = value
+            self.assertEqual(config.options(section, subsection), options)
+
+    def test_parse(self):
+        config = GitConfigFile(self.filename)
+        self.assert_same_as_git(config)
+        self.assertEqual(config.get('core', None, 'indented'), 'spaces around   the value')
+        self.assertEqual(config.get('submodule', 'mods/a', 'continued'), 'one two three')
+        self.assertEqual(config.get('deprecated', 'subsection', 'key'), 'deprecated syntax')
+        self.assertEqual(config.get_all('remote', 'origin', 'fetch')[1],
+                         '+refs/pull/*/head:refs/remotes/origin/pr/*')
+
+    def test_unchanged(self):
+        config = GitConfigFile(self.filename)
+        self.assertEqual(config.text(), TRICKY)
+
+    def test_set(self):
+        config = GitConfigFile(self.filename)
+        values = {'plain' : 'value', 'semicolon' : 'a;b', 'hash' : 'a#b',
+                  'spaces' : ' leading and trailing ', 'quote' : 'say "hi"',
+                  'backslash' : 'C:\\path\\', 'control' : 'tab\tnew\nline',
+                  'path' : 'mods/a-moved'}
+        for (key, value) in values.items():
+            config.set('submodule', 'mods/a', key, value)
+        config.set('submodule', 'new "one"', 'url', 'file:///new')
+        config.flush()
+
+        config = GitConfigFile(self.filename)
+        self.assert_same_as_git(config)
+        for (key, value) in values.items():
+            self.assertEqual(config.get('submodule', 'mods/a', key), value)
+        self.assertEqual(config.get('submodule', 'new "one"', 'url'), 'file:///new')
+
+        # Lines which were not changed are written back as they were
+        f = open(self.filename)
+        text = f.read()
+        f.close()
+        for line in ('# A comment before any section\n', '\tbare = false ; a comment after a value\n',
+                     '[Deprecated.SubSection]\n', '\tcontinued = one \\\ntwo \\\nthree\n'):
+            self.assertTrue(line in text)
+
+    def test_set_invalid_key(self):
+        config = GitConfigFile(self.filename)
+        for key in ('my_var', '1st', 'with space', 'dotted.key', ''):
+            self.assertRaises(ValueError, config.set, 'submodule', 'mods/a', key, 'value')
+        config.flush()
+        self.assert_same_as_git(GitConfigFile(self.filename))
+        self.assertEqual(GitConfigFile(self.filename).text(), TRICKY)
+
+    def test_unset(self):
+        config = GitConfigFile(self.filename)
+        config.unset('submodule', 'mods/a', 'path')
+        config.unset('remote', 'origin', 'fetch')
+        config.flush()
+        self.assert_same_as_git(GitConfigFile(self.filename))
+        names = [entry[:3] for entry in self.git_config()]
+        self.assertFalse(('submodule', 'mods/a', 'path') in names)
+        self.assertFalse(('remote', 'origin', 'fetch') in names)
+
+    def test_remove_section(self):
+        config = GitConfigFile(self.filename)
+        config.remove_section('submodule', 'mods/a')
+        config.remove_section('deprecated', 'subsection')
+        config.flush()
+        self.assert_same_as_git(GitConfigFile(self.filename))
+        sections = [entry[:2] for entry in self.git_config()]
+        self.assertFalse(('submodule', 'mods/a') in sections)
+        self.assertFalse(('deprecated', 'subsection') in sections)
+        self.assertTrue(('submodule', 'with "quotes" and spaces') in sections)
+
+    def test_rename_section(self):
+        config = GitConfigFile(self.filename)
+        before = config.options('submodule', 'mods/a')
+        config.rename_section('submodule', 'mods/a', 'mods/b "renamed"')
+        config.flush()
+        config = GitConfigFile(self.filename)
+        self.assert_same_as_git(config)
+        self.assertEqual(config.options('submodule', 'mods/b "renamed"'), before)
+        self.assertEqual(config.options('submodule', 'mods/a'), {})
+        paths = subprocess.check_output(['git', 'config', '--file', self.filename, '--get-all',
+                                         'submodule.mods/b "renamed".path']).decode('utf_8')
+        self.assertEqual(paths.splitlines(), ['mods/a', 'mods/a-again'])
+
+if __name__ == '__main__':
+    unittest.main()
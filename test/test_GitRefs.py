@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# test_GitRefs.py
+#
+# Tests for the GitRefs class of the GitSuperRepository package.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Check that GitRefs reads loose, packed, symbolic and annotated refs in the same
+way as git rev-parse, including through a .git file and the commondir of a
+linked worktree, and that submodule_state recognises a submodule checked out at
+an annotated tag.
+"""
+
+import os
+import shutil
+import unittest
+
+from helpers import git, TempDirTestCase
+from GitSuperRepository import GitRefs, GitSuperRepository
+
+class GitRefsTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        self.path = os.path.join(self.root, 'repo')
+        git(['init', '-q', '-b', 'master', self.path], self.root)
+        git(['commit', '-q', '--allow-empty', '-m', 'First commit'], self.path)
+        git(['tag', 'light'], self.path)
+        git(['tag', '-a', '-m', 'Annotated', 'annotated'], self.path)
+        git(['commit', '-q', '--allow-empty', '-m', 'Second commit'], self.path)
+        self.git_dir = os.path.join(self.path, '.git')
+
+    def tearDown(self):
+        TempDirTestCase.tearDown(self)
+
+    def rev_parse(self, rev, cwd=None):
+        return git(['rev-parse', rev], cwd or self.path)
+
+    def assert_same_as_git(self, refs, cwd=None):
+        for rev in ('HEAD', 'master', 'light', 'annotated', 'refs/tags/annotated'):
+            self.assertEqual(refs.lookup(rev), self.rev_parse(rev, cwd))
+        self.assertEqual(refs.symbolic_ref(), 'refs/heads/master')
+        self.assertEqual(refs.lookup('missing'), None)
+        listed = git(['for-each-ref', '--format=%(refname) %(objectname)'], cwd or self.path)
+        self.assertEqual(refs.list(), dict(line.split(' ') for line in listed.splitlines()))
+
+    def test_loose(self):
+        refs = GitRefs(self.git_dir)
+        self.assert_same_as_git(refs)
+        # Only packed-refs records the commit a loose annotated tag points to
+        self.assertEqual(refs.lookup('annotated', peel=True), self.rev_parse('annotated'))
+        self.assertEqual(refs.lookup('light', peel=True), self.rev_parse('light'))
+
+    def test_files_in_git_dir(self):
+        # Only pseudo-refs are looked for at the top of the git directory, so
+        # these are the tags and not the files of the same name
+        for name in ('description', 'index', 'config'):
+            git(['tag', name, 'light'], self.path)
+        refs = GitRefs(self.git_dir)
+        for name in ('description', 'index', 'config'):
+            self.assertEqual(refs.lookup(name), self.rev_parse(name))
+        git(['tag', '-d', 'index'], self.path)
+        self.assertEqual(refs.lookup('index'), None)
+        self.assertEqual(refs.read('index'), None)
+        self.assertEqual(refs.read('description'), None)
+
+        git(['update-ref', 'ORIG_HEAD', 'light'], self.path)
+        self.assertEqual(refs.lookup('ORIG_HEAD'), self.rev_parse('ORIG_HEAD'))
+        self.assertEqual(refs.lookup('refs/heads/master'), self.rev_parse('master'))
+
+    def test_packed(self):
+        git(['pack-refs', '--all'], self.path)
+        refs = GitRefs(self.git_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.git_dir, 'refs', 'tags', 'annotated')))
+        self.assert_same_as_git(refs)
+        self.assertEqual(refs.lookup('annotated', peel=True), self.rev_parse('annotated^{commit}'))
+        self.assertEqual(refs.lookup('light', peel=True), self.rev_parse('light'))
+
+        # A loose ref takes precedence over, and is not peeled by, packed-refs
+        git(['tag', '-f', 'annotated', 'master'], self.path)
+        self.assertEqual(refs.lookup('annotated'), self.rev_parse('master'))
+        self.assertEqual(refs.lookup('annotated', peel=True), self.rev_parse('master'))
+
+        # packed-refs is read again once it changes
+        git(['commit', '-q', '--allow-empty', '-m', 'Third commit'], self.path)
+        git(['pack-refs', '--all'], self.path)
+        self.assert_same_as_git(refs)
+
+    def test_gitfile(self):
+        moved = os.path.join(self.root, 'moved.git')
+        shutil.move(self.git_dir, moved)
+        f = open(os.path.join(self.path, '.git'), 'w')
+        f.write('gitdir: ' + moved + '\n')
+        f.close()
+        git(['worktree', 'add', '-q', '-b', 'other', os.path.join(self.root, 'worktree')],
+            self.path)
+        worktree = os.path.join(self.root, 'worktree')
+
+        refs = GitRefs(moved)
+        self.assert_same_as_git(refs)
+        self.assertEqual(refs.common_dir(), moved)
+
+        # HEAD belongs to the linked worktree, everything else to the common directory
+        refs = GitRefs(git(['rev-parse', '--absolute-git-dir'], worktree))
+        self.assertEqual(refs.common_dir(), moved)
+        self.assertEqual(refs.symbolic_ref(), 'refs/heads/other')
+        self.assertEqual(refs.lookup('HEAD'), self.rev_parse('HEAD', worktree))
+        self.assertEqual(refs.lookup('annotated'), self.rev_parse('annotated', worktree))
+
+class SubmoduleStateTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        upstream = os.path.join(self.root, 'upstream')
+        git(['init', '-q', '-b', 'master', upstream], self.root)
+        git(['commit', '-q', '--allow-empty', '-m', 'First commit'], upstream)
+        git(['tag', '-a', '-m', 'Release', 'v1'], upstream)
+        git(['commit', '-q', '--allow-empty', '-m', 'Second commit'], upstream)
+
+        self.path = os.path.join(self.root, 'super')
+        git(['init', '-q', self.path], self.root)
+        git(['submodule', 'add', '-q', 'file://' + upstream, 'mods/a'], self.path)
+        git(['config', '--file', '.gitmodules', 'submodule.mods/a.revision', 'v1'], self.path)
+        self.module = os.path.join(self.path, 'mods', 'a')
+        self.sr = GitSuperRepository(self.path)
+
+    def tearDown(self):
+        self.sr.close()
+        TempDirTestCase.tearDown(self)
+
+    def test_annotated_tag(self):
+        # The clone packs its refs, so make a loose copy of the tag first
+        git(['tag', '-d', 'v1'], self.module)
+        git(['tag', '-a', '-m', 'Release', 'v1', 'master^'], self.module)
+        self.assertTrue(os.path.exists(os.path.join(self.sr.module_git_dir('mods/a'),
+                                                    'refs', 'tags', 'v1')))
+        git(['checkout', '-q', 'v1'], self.module)
+        self.assertEqual(self.sr.submodule_state('mods/a')['status'], 'on-revision')
+        git(['pack-refs', '--all'], self.module)
+        self.assertEqual(self.sr.submodule_state('mods/a')['status'], 'on-revision')
+
+        git(['checkout', '-q', 'master^0'], self.module)
+        self.assertEqual(self.sr.submodule_state('mods/a')['status'], 'detached')
+
+if __name__ == '__main__':
+    unittest.main()
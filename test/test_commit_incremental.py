@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# test_commit_incremental.py
+#
+# Tests for the commit_submodule_updates method of the GitSuperRepository
+# package, which is used by git-module commit-incremental --fast-import.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Commit new submodule commits to a super-repository with a single fast-import
+stream. Check the commits which are created, and that HEAD, the index and the
+temporary ref are left as they were whenever creating them fails.
+"""
+
+import os
+import subprocess
+import unittest
+
+from helpers import git, TempDirTestCase
+from GitSuperRepository import GitSuperRepository
+
+class CommitIncrementalTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+
+        upstream = os.path.join(self.root, 'upstream')
+        git(['init', '-q', '-b', 'master', upstream], self.root)
+        git(['commit', '-q', '--allow-empty', '-m', 'Initial commit'], upstream)
+
+        self.path = os.path.join(self.root, 'super')
+        git(['init', '-q', self.path], self.root)
+        for module in ('mods/a', 'mods/b'):
+            git(['submodule', 'add', '-q', 'file://' + upstream, module], self.path)
+        git(['commit', '-q', '-m', 'Add submodules'], self.path)
+
+        # Two new commits in mods/a and one in mods/b
+        for (module, subject) in (('mods/a', 'First change'), ('mods/a', 'Second change'),
+                                  ('mods/b', 'Other change')):
+            git(['commit', '-q', '--allow-empty', '-m', subject,
+                 '--author', 'Someone <someone@example.com>'],
+                os.path.join(self.path, module))
+        self.sr = GitSuperRepository(self.path)
+        self.commits = [(module, commit) for module in ('mods/a', 'mods/b')
+                        for commit in self.sr.submodule_log_since(
+                            module, self.sr.current_submodule_commit(module))]
+
+    def tearDown(self):
+        self.sr.close()
+        TempDirTestCase.tearDown(self)
+
+    def state(self):
+        """Get everything a failed commit should leave unchanged."""
+        return (git(['rev-parse', 'HEAD'], self.path), git(['ls-files', '--stage'], self.path),
+                git(['for-each-ref', 'refs/git-module'], self.path))
+
+    def test_commit(self):
+        head = self.sr.commit_submodule_updates(iter(self.commits))
+        self.assertEqual(git(['rev-parse', 'HEAD'], self.path), head)
+        self.assertEqual(git(['log', '--format=%an %s', 'HEAD~3..'], self.path).splitlines(),
+                         ['Someone Other change', 'Someone Second change',
+                          'Someone First change'])
+        for module in ('mods/a', 'mods/b'):
+            sha1 = git(['rev-parse', 'HEAD'], os.path.join(self.path, module))
+            self.assertEqual(git(['rev-parse', 'HEAD:' + module], self.path), sha1)
+            self.assertEqual(git(['rev-parse', ':' + module], self.path), sha1)
+        self.assertEqual(git(['for-each-ref', 'refs/git-module'], self.path), '')
+        self.assertEqual(git(['status', '--porcelain'], self.path), '')
+
+    def test_nothing_to_commit(self):
+        before = self.state()
+        self.assertEqual(self.sr.commit_submodule_updates([]), before[0])
+        self.assertEqual(self.state(), before)
+
+    def test_failed_fast_import(self):
+        before = self.state()
+        (module, commit) = self.commits[-1]
+        commits = self.commits[:-1] + [(module, dict(commit, SHA1='not-an-object-name'))]
+        self.assertRaises(subprocess.CalledProcessError,
+                          self.sr.commit_submodule_updates, iter(commits))
+        self.assertEqual(self.state(), before)
+
+    def test_failed_log(self):
+        before = self.state()
+        def commits():
+            for item in self.commits[:2]:
+                yield item
+            raise subprocess.CalledProcessError(128, ['git', 'log'])
+        self.assertRaises(subprocess.CalledProcessError,
+                          self.sr.commit_submodule_updates, commits())
+        self.assertEqual(self.state(), before)
+
+    def test_failed_index_update(self):
+        before = self.state()
+        def git_input(command, input, module=None):
+            raise subprocess.CalledProcessError(128, ['git'] + command)
+        self.sr.git_input = git_input
+        self.assertRaises(subprocess.CalledProcessError,
+                          self.sr.commit_submodule_updates, iter(self.commits))
+        self.assertEqual(self.state(), before)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# test_divergence.py
+#
+# Tests for branch_status and the DivergenceCache class of the
+# GitSuperRepository package.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Check that branch_status finds the upstream of a branch in the same way as git
+when its remote has several fetch refspecs, that its results follow the
+branches as they move, and that DivergenceCache only writes its file on
+flush(), dropping the least recently used entries to stay under its size limit.
+"""
+
+import os
+import unittest
+
+from helpers import git, TempDirTestCase
+from GitSuperRepository import DivergenceCache, GitSuperRepository, Tracer
+
+class BranchStatusTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.upstream = os.path.join(self.root, 'upstream')
+        git(['init', '-q', '-b', 'master', self.upstream], self.root)
+        git(['commit', '-q', '--allow-empty', '-m', 'Initial commit'], self.upstream)
+
+        self.path = os.path.join(self.root, 'super')
+        git(['init', '-q', self.path], self.root)
+        git(['submodule', 'add', '-q', 'file://' + self.upstream, 'mods/a'], self.path)
+        self.module = os.path.join(self.path, 'mods', 'a')
+
+        # Only the first of several refspecs maps the branches of the remote
+        git(['config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/mirror/*'],
+            self.module)
+        for refspec in ('+refs/pull/*/head:refs/remotes/origin/pr/*', '^refs/heads/skip'):
+            git(['config', '--add', 'remote.origin.fetch', refspec], self.module)
+        self.upstream_commit('Upstream change')
+        git(['commit', '-q', '--allow-empty', '-m', 'Local change'], self.module)
+        self.sr = GitSuperRepository(self.path)
+
+    def tearDown(self):
+        self.sr.close()
+        TempDirTestCase.tearDown(self)
+
+    def upstream_commit(self, subject):
+        git(['commit', '-q', '--allow-empty', '-m', subject], self.upstream)
+        git(['fetch', '-q'], self.module)
+
+    def counts(self):
+        statuses = dict(self.sr.branch_status('mods/a'))
+        status = statuses['master']
+        return (status['upstream'], status['only-upstream-count'],
+                status['only-downstream-count'], [c['title'] for c in status['only-upstream']])
+
+    def test_refspecs(self):
+        self.assertEqual(git(['rev-parse', '--symbolic-full-name', 'master@{upstream}'],
+                             self.module), 'refs/remotes/mirror/master')
+        tracer = Tracer()
+        self.sr.set_tracer(tracer)
+        self.assertEqual(self.counts(),
+                         ('refs/remotes/mirror/master', 1, 1, ['Upstream change']))
+        # The upstream was found from the refspecs, without asking git
+        self.assertFalse('git for-each-ref' in [tracer.verb(r['command'])
+                                                for r in tracer.records()])
+
+    def test_moved_branches(self):
+        self.assertEqual(self.counts()[1:3], (1, 1))
+        cache = os.path.join(self.path, '.git', 'git-module', 'divergence')
+        self.assertEqual(len(os.listdir(cache)), 1)
+
+        # New commits give a new key, so the cached result is not used for them
+        self.upstream_commit('Another upstream change')
+        self.assertEqual(self.counts(),
+                         ('refs/remotes/mirror/master', 2, 1,
+                          ['Another upstream change', 'Upstream change']))
+        git(['merge', '-q', '-m', 'Merge', 'mirror/master'], self.module)
+        self.assertEqual(self.counts()[1:3], (0, 2))
+
+class DivergenceCacheTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.filename = os.path.join(self.root, 'cache', 'divergence')
+
+    def read(self):
+        f = open(self.filename)
+        text = f.read()
+        f.close()
+        return text
+
+    def test_flush(self):
+        cache = DivergenceCache(self.filename)
+        cache.put(('a', 'b'), {'count' : 1})
+        self.assertEqual(cache.get(('a', 'b')), {'count' : 1})
+        self.assertFalse(os.path.exists(self.filename))
+        cache.flush()
+        self.assertEqual(DivergenceCache(self.filename).get(('a', 'b')), {'count' : 1})
+
+        # Looking entries up never writes the file
+        text = self.read()
+        signature = os.stat(self.filename).st_mtime
+        cache = DivergenceCache(self.filename)
+        self.assertEqual(cache.get(('a', 'b')), {'count' : 1})
+        self.assertEqual(cache.get(('a', 'c')), None)
+        cache.flush()
+        self.assertEqual(self.read(), text)
+        self.assertEqual(os.stat(self.filename).st_mtime, signature)
+
+    def test_other_writers(self):
+        first  = DivergenceCache(self.filename)
+        second = DivergenceCache(self.filename)
+        first.put(('a', 'b'), 1)
+        first.flush()
+        second.put(('c', 'd'), 2)
+        second.flush()
+        # Entries written by another cache are read, and not overwritten
+        self.assertEqual(first.get(('c', 'd')), 2)
+        self.assertEqual(DivergenceCache(self.filename).get(('a', 'b')), 1)
+
+    def test_eviction(self):
+        value = 'x' * 50
+        cache = DivergenceCache(self.filename, max_size=200)
+        for key in ('a', 'b', 'c'):
+            cache.put((key, key), value)
+        cache.get(('a', 'a'))
+        cache.put(('d', 'd'), value)
+        cache.flush()
+
+        # Only the most recently used entries which fit are kept
+        cache = DivergenceCache(self.filename, max_size=200)
+        self.assertEqual([key for key in ('a', 'b', 'c', 'd') if cache.get((key, key)) != None],
+                         ['a', 'd'])
+        self.assertTrue(len(self.read()) <= 200)
+
+        # An entry larger than the whole cache is not stored
+        cache.put(('e', 'e'), 'x' * 500)
+        cache.flush()
+        self.assertEqual(DivergenceCache(self.filename, max_size=200).get(('e', 'e')), None)
+
+if __name__ == '__main__':
+    unittest.main()
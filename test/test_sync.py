@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# test_sync.py
+#
+# Tests for the sync_gitmodules method of the GitSuperRepository package.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Synchronise a super-repository built from local file:// repositories with
+changes to its .gitmodules. Check that relative URLs are resolved in the same
+way as git submodule, and that a sync which fails leaves the clones, the index
+and .git/config as they were.
+"""
+
+from __future__ import print_function
+
+import sys, os
+import subprocess
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from helpers import git, TempDirTestCase
+from GitSuperRepository import GitSuperRepository
+
+class SyncTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        os.environ['GIT_CONFIG_COUNT'] = '1'
+        os.environ['GIT_CONFIG_KEY_0'] = 'protocol.file.allow'
+        os.environ['GIT_CONFIG_VALUE_0'] = 'always'
+
+        # Upstream repositories next to the one the super-repository was cloned from
+        self.remote = os.path.join(self.root, 'remote')
+        for name in ('a', 'b'):
+            upstream = os.path.join(self.remote, name)
+            git(['init', '-q', '-b', 'master', upstream], self.root)
+            git(['commit', '-q', '--allow-empty', '-m', 'Initial commit of ' + name], upstream)
+
+        self.path = os.path.join(self.root, 'super')
+        git(['init', '-q', '-b', 'master', self.path], self.root)
+        git(['remote', 'add', 'origin', 'file://' + os.path.join(self.remote, 'super')], self.path)
+        git(['submodule', 'add', '-q', 'file://' + os.path.join(self.remote, 'a'), 'mods/a'],
+            self.path)
+        git(['commit', '-q', '-m', 'Add mods/a'], self.path)
+        self.sr = GitSuperRepository(self.path)
+
+    def tearDown(self):
+        self.sr.close()
+        TempDirTestCase.tearDown(self)
+
+    def add_to_gitmodules(self, module, url):
+        for (key, value) in (('path', module), ('url', url)):
+            git(['config', '--file', '.gitmodules', 'submodule.' + module + '.' + key, value],
+                self.path)
+
+    def state(self):
+        """Get everything a failed sync should leave unchanged."""
+        f = open(os.path.join(self.path, '.git', 'config'))
+        config = f.read()
+        f.close()
+        return (config, git(['ls-files', '--stage'], self.path),
+                sorted(os.listdir(os.path.join(self.path, 'mods'))),
+                sorted(os.listdir(os.path.join(self.path, '.git', 'modules', 'mods'))))
+
+    def sync(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            return self.sr.sync_gitmodules(jobs=2)
+        finally:
+            sys.stdout = stdout
+
+    def test_resolve_url(self):
+        remote = 'file://' + self.remote
+        self.assertEqual(self.sr.resolve_url('../b'), remote + '/b')
+        self.assertEqual(self.sr.resolve_url('./../b'), remote + '/b')
+        self.assertEqual(self.sr.resolve_url('./b'), remote + '/super/b')
+        self.assertEqual(self.sr.resolve_url('https://example.com/b'), 'https://example.com/b')
+
+        git(['remote', 'set-url', 'origin', 'host:path/super'], self.path)
+        self.assertEqual(self.sr.resolve_url('../b'), 'host:path/b')
+        self.assertEqual(self.sr.resolve_url('../../b'), 'host:b')
+
+        # The remote of the branch checked out is used before origin
+        git(['remote', 'add', 'other', 'file:///other/super'], self.path)
+        git(['config', 'branch.master.remote', 'other'], self.path)
+        self.assertEqual(self.sr.resolve_url('../b'), 'file:///other/b')
+
+        # Without a remote, URLs are relative to the super-repository itself
+        git(['remote', 'remove', 'origin'], self.path)
+        git(['remote', 'remove', 'other'], self.path)
+        self.assertEqual(self.sr.resolve_url('../remote/b'), self.root + '/remote/b')
+
+    def test_relative_url(self):
+        self.add_to_gitmodules('mods/b', '../b')
+        self.assertEqual(self.sync(), {})
+        module = os.path.join(self.path, 'mods', 'b')
+        self.assertEqual(git(['config', 'submodule.mods/b.url'], self.path),
+                         'file://' + os.path.join(self.remote, 'b'))
+        self.assertEqual(git(['log', '-1', '--format=%s'], module), 'Initial commit of b')
+        self.assertEqual(git(['rev-parse', '--absolute-git-dir'], module),
+                         os.path.join(self.path, '.git', 'modules', 'mods', 'b'))
+        self.assertEqual(git(['ls-files', '--stage', 'mods/b'], self.path).split()[0], '160000')
+
+    def test_failed_clone(self):
+        before = self.state()
+        self.add_to_gitmodules('mods/b', '../b')
+        self.add_to_gitmodules('mods/c', '../missing')
+        errors = self.sync()
+        self.assertEqual(list(errors), ['mods/c'])
+        # mods/b was cloned, but is removed again
+        self.assertEqual(self.state(), before)
+
+    def test_failed_index_update(self):
+        before = self.state()
+        git(['config', '--file', '.gitmodules', '--remove-section', 'submodule.mods/a'], self.path)
+        self.add_to_gitmodules('mods/b', '../b')
+
+        def git_input(command, input, module=None):
+            raise subprocess.CalledProcessError(128, ['git'] + command)
+        self.sr.git_input = git_input
+        self.assertRaises(subprocess.CalledProcessError, self.sync)
+        self.assertEqual(self.state(), before)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#
+# test_upstream_init.py
+#
+# Tests for GitSuperRepository.upstream_init and upstream_init_modules.
+#
+# Copyright (C) 2011 Barry Wardell <barry.wardell@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+# PARTICULAR PURPOSE. See the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License along
+# with this library; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""
+Initialise the upstream repositories of submodules of a super-repository built
+from local file:// repositories. Mercurial and git-svn are replaced by stand-in
+scripts which record their command lines, so that the steps run for hg and svn
+submodules and how an interrupted initialisation is resumed can be checked
+without them.
+"""
+
+from __future__ import print_function
+
+import sys, os
+import json
+import subprocess
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from helpers import git, TempDirTestCase
+from GitSuperRepository import GitSuperRepository
+
+FAKE_HG = '''#!/bin/sh
+echo "$*" >> "$FAKE_HG_LOG"
+if [ "$1" = clone ]; then
+    mkdir -p "$3/.hg" && touch "$3/.hg/hgrc"
+    if [ -n "$FAKE_HG_FAIL_CLONE" ]; then echo "abort: interrupted" >&2; exit 255; fi
+fi
+if [ "$3" = gexport ] && [ -n "$FAKE_HG_FAIL_GEXPORT" ]; then
+    echo "abort: gexport failed" >&2; exit 255
+fi
+exit 0
+'''
+
+FAKE_GIT_SVN = '''#!/bin/sh
+echo "$*" >> "$FAKE_SVN_LOG"
+if [ "$1" = fetch ] && [ -n "$FAKE_SVN_FAIL_FETCH" ]; then
+    echo "Connection reset by peer" >&2; exit 1
+fi
+exit 0
+'''
+
+class UpstreamInitTest(TempDirTestCase):
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        bin_dir = os.path.join(self.root, 'bin')
+        os.makedirs(bin_dir)
+        for (name, script) in (('hg', FAKE_HG), ('git-svn', FAKE_GIT_SVN)):
+            f = open(os.path.join(bin_dir, name), 'w')
+            f.write(script)
+            f.close()
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+        self.hg_log = os.path.join(self.root, 'hg.log')
+        self.svn_log = os.path.join(self.root, 'svn.log')
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_HG_LOG'] = self.hg_log
+        os.environ['FAKE_SVN_LOG'] = self.svn_log
+
+        upstream = os.path.join(self.root, 'upstream')
+        git(['init', '-q', '-b', 'master', upstream], self.root)
+        git(['commit', '-q', '--allow-empty', '-m', 'Initial commit'], upstream)
+        self.url = 'file://' + upstream
+
+        self.path = os.path.join(self.root, 'super')
+        git(['init', '-q', self.path], self.root)
+        for (module, type) in (('mods/git', 'git'), ('mods/hg', 'hg'), ('mods/svn', 'svn')):
+            git(['submodule', 'add', '-q', self.url, module], self.path)
+            for (key, value) in (('upstreamurl', self.url), ('upstreamtype', type),
+                                 ('revision', 'master')):
+                git(['config', '--file', '.gitmodules',
+                     'submodule.' + module + '.' + key, value], self.path)
+        self.sr = GitSuperRepository(self.path)
+        self.hg_path = os.path.join(self.path, 'mods', 'hg.hg')
+
+    def tearDown(self):
+        self.sr.close()
+        TempDirTestCase.tearDown(self)
+
+    def hg_commands(self):
+        if not os.path.exists(self.hg_log):
+            return []
+        f = open(self.hg_log)
+        commands = [line.split()[0] if line.startswith('clone') else line.split()[2]
+                    for line in f]
+        f.close()
+        return commands
+
+    def svn_commands(self):
+        if not os.path.exists(self.svn_log):
+            return []
+        f = open(self.svn_log)
+        commands = f.read().splitlines()
+        f.close()
+        return commands
+
+    def state(self):
+        f = open(self.sr.upstream_init_state_file())
+        state = json.load(f)
+        f.close()
+        return state
+
+    def init_modules(self, modules):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            return self.sr.upstream_init_modules(modules, jobs=2)
+        finally:
+            sys.stdout = stdout
+
+    def test_git(self):
+        self.assertEqual(self.sr.upstream_init('mods/git'), 'initialised')
+        self.assertEqual(git(['config', 'remote.origin.pushurl'],
+                             os.path.join(self.path, 'mods', 'git')), self.url)
+        self.assertEqual(self.state()['mods/git']['steps'], ['push-url'])
+        self.assertEqual(self.sr.upstream_init('mods/git'), 'unchanged')
+        self.assertEqual(self.sr.upstream_init('mods/git', restart=True), 'initialised')
+
+    def test_resume(self):
+        os.environ['FAKE_HG_FAIL_GEXPORT'] = '1'
+        errors = self.init_modules(['mods/git', 'mods/hg'])
+        self.assertEqual(list(errors), ['mods/hg'])
+        self.assertTrue('gexport failed' in errors['mods/hg'])
+        self.assertEqual(self.state()['mods/hg']['steps'], ['hg-clone', 'hgrc', 'bookmark'])
+
+        # Only the failed step and those after it are run again
+        del os.environ['FAKE_HG_FAIL_GEXPORT']
+        self.assertEqual(self.init_modules(['mods/git', 'mods/hg']), {})
+        self.assertEqual(self.hg_commands(),
+                         ['clone', 'bookmark', 'gexport', 'gexport', 'pull'])
+        self.assertEqual(self.state()['mods/hg']['steps'],
+                         ['hg-clone', 'hgrc', 'bookmark', 'gexport', 'pull'])
+        self.assertEqual(self.sr.upstream_init('mods/hg'), 'unchanged')
+
+        # hgrc is only written once
+        f = open(os.path.join(self.hg_path, '.hg', 'hgrc'))
+        self.assertEqual(f.read().count('[paths]'), 1)
+        f.close()
+
+    def test_interrupted_clone(self):
+        os.environ['FAKE_HG_FAIL_CLONE'] = '1'
+        self.assertRaises(subprocess.CalledProcessError, self.sr.upstream_init, 'mods/hg')
+        self.assertEqual(self.state()['mods/hg']['started'], 'hg-clone')
+
+        # The partial clone was started by upstream_init, so it is replaced
+        del os.environ['FAKE_HG_FAIL_CLONE']
+        self.assertEqual(self.sr.upstream_init('mods/hg'), 'initialised')
+        self.assertEqual(self.hg_commands().count('clone'), 2)
+
+    def test_svn(self):
+        # A real git-svn in git's exec path would be run instead of the stand-in
+        exec_path = git(['--exec-path'], self.root)
+        if os.path.exists(os.path.join(exec_path, 'git-svn')):
+            self.skipTest('git-svn is installed')
+
+        os.environ['FAKE_SVN_FAIL_FETCH'] = '1'
+        errors = self.init_modules(['mods/svn'])
+        self.assertEqual(list(errors), ['mods/svn'])
+        self.assertTrue('Connection reset' in errors['mods/svn'])
+        self.assertEqual(self.state()['mods/svn']['steps'], ['checkout', 'svn-init'])
+        self.assertEqual(git(['symbolic-ref', 'HEAD'], os.path.join(self.path, 'mods', 'svn')),
+                         'refs/heads/master')
+
+        # svn init is not run again when the fetch is resumed
+        del os.environ['FAKE_SVN_FAIL_FETCH']
+        self.assertEqual(self.sr.upstream_init('mods/svn'), 'resumed')
+        self.assertEqual(self.svn_commands(),
+                         ['init -s --prefix=origin/ ' + self.url, 'fetch', 'fetch'])
+        self.assertEqual(self.state()['mods/svn']['steps'],
+                         ['checkout', 'svn-init', 'svn-fetch'])
+        self.assertEqual(self.sr.upstream_init('mods/svn'), 'unchanged')
+
+    def test_existing_clone(self):
+        os.makedirs(self.hg_path)
+        work = os.path.join(self.hg_path, 'work')
+        open(work, 'w').close()
+
+        # A clone which upstream_init did not start is never removed
+        self.assertRaises(ValueError, self.sr.upstream_init, 'mods/hg')
+        self.assertRaises(ValueError, self.sr.upstream_init, 'mods/hg', True)
+        self.assertTrue(os.path.exists(work))
+        self.assertEqual(self.hg_commands(), [])
+
+if __name__ == '__main__':
+    unittest.main()